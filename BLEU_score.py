@@ -1,5 +1,8 @@
 import math
+from collections import Counter
+from instrumentation import *
 
+@instrumented('BLEU_score')
 def BLEU_score(candidate, references, n, brevity=False):
 	"""
 	Calculate the BLEU score given a candidate sentence (string) and a list of reference sentences (list of strings). n specifies the level to calculate.
@@ -19,51 +22,150 @@ def BLEU_score(candidate, references, n, brevity=False):
 	bleu_score :	(float) The BLEU score
 	"""
 
-	candidate_n = to_ngram(candidate, n)
-	N = len(candidate_n)
+	stats = bleu_stats(candidate, references, n, orders=[n])
+	bleu_score = precision(stats, n)
 
-	references_n = list()
+	if brevity > 0:
+		# TODO: add the 1/n?
+		# bleu_score = bleu_score ** (1 / n)
+		bleu_score *= brevity_penalty(stats['length'], stats['ref_length'])
+	return bleu_score
 
-	for reference in references:
-		references_n.append(to_ngram(reference, n))
 
-	C = 0
-	for ngram in candidate_n:
-		j = 0
-		flag = False
+def bleu_stats(candidate, references, n, orders=None):
+	"""
+	Collect the sufficient statistics of BLEU for one candidate in a single pass.
 
-		while j != len(references_n) and flag is False:
-			if ngram in references_n[j]:
-				C += 1
-				flag = True
-			else:
-				j += 1
+	Every n-gram order is extracted once per sentence as a Counter of tuples. A
+	candidate n-gram matches if it appears in any reference; as in BLEU_score, the
+	matches are not clipped by the reference counts.
 
-	bleu_score = (C / N)
+	INPUTS:
+	candidate :	(string) Candidate sentence
+	references:	(list) List containing reference sentences
+	n :			(int) the highest n-gram order
+	orders :	(list) the orders to collect, all of 1..n by default
 
-	if brevity > 0:
-		# TODO: add the 1/n?
-		# bleu_score = bleu_score ** (1 / n)
-		diff = None
-		candidate_length = len(candidate.split(' '))
-		reference_length = None
+	OUTPUT:
+	stats :		(dictionary) 'matches'[k - 1] and 'totals'[k - 1] are the number of
+				matched and of all candidate k-grams, 'length' is the candidate length and
+				'ref_length' the length of the reference closest to it
+	"""
+	if orders is None:
+		orders = range(1, n + 1)
+	words = candidate.split(' ')
+	references = [reference.split(' ') for reference in references]
+
+	matches = [0] * n
+	totals = [0] * n
+	for k in orders:
+		reference_ngrams = set()
 		for reference in references:
-			ref_length = len(reference.split(' '))
-			tmp_diff = math.fabs(candidate_length - ref_length)
-			if diff is None or tmp_diff < diff:
-				diff = tmp_diff
-				reference_length = ref_length
-		brevity_score = reference_length / candidate_length
-
-		if brevity_score >= 1:
-			brevity_score = math.exp(1 - brevity_score)
-		else:
-			brevity_score = 1
-
-		bleu_score *= brevity_score
+			reference_ngrams.update(ngrams(reference, k))
+		for ngram, count in ngrams(words, k).items():
+			totals[k - 1] += count
+			if ngram in reference_ngrams:
+				matches[k - 1] += count
+
+	return {'matches': matches, 'totals': totals, 'length': len(words),
+			'ref_length': closest_length(len(words), [len(reference) for reference in references])}
+
+
+def ngrams(words, n):
+	"""
+	Counter of the n-grams (as tuples) of a list of words.
+	"""
+	return Counter(zip(*[words[i:] for i in range(n)]))
+
+
+def closest_length(candidate_length, reference_lengths):
+	"""
+	The reference length closest to the candidate length; the first one on ties.
+	"""
+	diff = None
+	reference_length = None
+	for ref_length in reference_lengths:
+		tmp_diff = math.fabs(candidate_length - ref_length)
+		if diff is None or tmp_diff < diff:
+			diff = tmp_diff
+			reference_length = ref_length
+	return reference_length
+
+
+def brevity_penalty(candidate_length, reference_length):
+	"""
+	The brevity factor BLEU_score applies for the given lengths.
+	"""
+	brevity_score = reference_length / candidate_length
+
+	if brevity_score >= 1:
+		brevity_score = math.exp(1 - brevity_score)
+	else:
+		brevity_score = 1
+	return brevity_score
+
+
+def precision(stats, k):
+	"""
+	The k-gram precision of bleu_stats (or summed) statistics, 0 without k-grams.
+	"""
+	if stats['totals'][k - 1] == 0:
+		return 0
+	return stats['matches'][k - 1] / stats['totals'][k - 1]
+
+
+def bleu_from_stats(stats, n):
+	"""
+	The geometric mean of the 1..n-gram precisions times the brevity penalty, as
+	evalAlign._get_BLEU_scores computes it.
+	"""
+	bleu_score = 1
+	for k in range(1, n + 1):
+		bleu_score *= precision(stats, k)
+	bleu_score = bleu_score ** (1 / n)
+	bleu_score *= brevity_penalty(stats['length'], stats['ref_length'])
 	return bleu_score
 
 
+@instrumented('sentence_bleu')
+def sentence_bleu(candidate, references, n):
+	"""
+	The n-gram BLEU score of one candidate sentence, computed in one pass.
+	"""
+	return bleu_from_stats(bleu_stats(candidate, references, n), n)
+
+
+def corpus_bleu(candidates, references, n):
+	"""
+	Corpus-level BLEU: the match and n-gram counts and the candidate and closest
+	reference lengths are summed over all sentences before the precisions and the
+	brevity penalty are computed.
+
+	INPUTS:
+	candidates :	(list) candidate sentences
+	references :	(list) for every candidate, the list of its reference sentences
+	n :				(int) the highest n-gram order
+
+	OUTPUT:
+	bleu_score :	(float) the corpus BLEU score
+	"""
+	return bleu_from_stats(sum_stats([bleu_stats(c, r, n) for c, r in zip(candidates, references)], n), n)
+
+
+def sum_stats(all_stats, n):
+	"""
+	Add up the bleu_stats of several sentences.
+	"""
+	total = {'matches': [0] * n, 'totals': [0] * n, 'length': 0, 'ref_length': 0}
+	for stats in all_stats:
+		for k in range(n):
+			total['matches'][k] += stats['matches'][k]
+			total['totals'][k] += stats['totals'][k]
+		total['length'] += stats['length']
+		total['ref_length'] += stats['ref_length']
+	return total
+
+
 def to_ngram(string, n):
 	ngram_list = []
 	words = string.split(' ')
@@ -1,10 +1,19 @@
 from lm_train import *
 from log_prob import *
 from preprocess import *
+from preprocess_cache import *
+from align_ibm1_sparse import *
+from hansard_corpus import *
+from instrumentation import *
 from math import log
+import numpy as np
+import time
+import json
 import os
 
-def align_ibm1(train_dir, num_sentences, max_iter, fn_AM):
+def align_ibm1(train_dir, num_sentences, max_iter, fn_AM, backend='python', workers=1, batch_size=None,
+               init_AM=None, checkpoint_every=None, resume=False, tol=None, callback=None, log_file=None,
+               prune_threshold=None, prune_top_k=None, prune_at=None):
     """
     Implements the training of IBM-1 word alignment algoirthm.
     We assume that we are implemented P(foreign|english)
@@ -12,9 +21,33 @@ def align_ibm1(train_dir, num_sentences, max_iter, fn_AM):
     INPUTS:
     train_dir : 	(string) The top-level directory name containing data
                     e.g., '/u/cs401/A2_SMT/data/Hansard/Testing/'
+                    or a corpus compiled by hansard_corpus.compile_hansard
     num_sentences : (int) the maximum number of training sentences to consider
     max_iter : 		(int) the maximum number of iterations of the EM algorithm
     fn_AM : 		(string) the location to save the alignment model
+    backend :       (string) 'python' for the dictionary implementation, 'numpy' for the
+                    vectorized engine in align_ibm1_sparse. Both give the same AM.
+    workers :       (int) the number of processes to shard the EM steps over. Values
+                    above 1 require backend='numpy'.
+    batch_size :    (int) with backend='numpy' and a compiled corpus, stream the corpus
+                    from disk this many sentences at a time instead of holding it in memory.
+    init_AM :       (dictionary or string) warm-start EM from this AM (or the AM saved at
+                    init_AM + '.pickle') instead of the uniform initialization, e.g.
+                    to continue a model trained on fewer sentences (see warm_start)
+    checkpoint_every : (int) save the AM to fn_AM + '.checkpoint.pickle' every this many
+                    iterations. The checkpoint is removed once training finishes.
+    resume :        (boolean) continue from the checkpoint of an interrupted run with the
+                    same parameters, running only the remaining iterations
+    tol :           (float) stop early once no probability changes by more than tol in an
+                    iteration
+    callback :      (function) called after every iteration with a dictionary of metrics:
+                    'iteration', 'seconds', 'table_size' (the number of pairs), 'max_change'
+                    and 'mean_change' of the probabilities and 'log_likelihood' of the corpus
+    log_file :      (string) append the same metrics to this file, one JSON object per line
+    prune_threshold : (float) drop the pairs whose probability is below this threshold
+    prune_top_k :   (int) keep only the top_k most probable French words of every English word
+    prune_at :      (list) the iterations after which to prune (see prune), every iteration
+                    by default. The saved AM is always pruned.
 
     OUTPUT:
     AM :			(dictionary) alignment model structure
@@ -26,23 +59,116 @@ def align_ibm1(train_dir, num_sentences, max_iter, fn_AM):
     """
     AM = {}
 
-    # Read training data
-    data = read_hansard(train_dir, num_sentences)
+    if workers > 1 and backend != 'numpy':
+        raise ValueError("workers > 1 requires backend='numpy'")
 
-    AM = initialize(data[0], data[1])
-    print(len(data[0]))
+    params = {'train_dir': os.path.abspath(train_dir), 'num_sentences': num_sentences, 'max_iter': max_iter,
+              'prune_threshold': prune_threshold, 'prune_top_k': prune_top_k,
+              'prune_at': None if prune_at is None else sorted(prune_at)}
+    pruning = prune_threshold is not None or prune_top_k is not None
+    done = 0
+    if resume and os.path.exists(fn_AM + '.checkpoint.pickle'):
+        with open(fn_AM + '.checkpoint.pickle', 'rb') as handle:
+            checkpoint = pickle.load(handle)
+        if checkpoint['params'] != params:
+            raise ValueError('{}.checkpoint.pickle was saved with other parameters: {}'.format(
+                fn_AM, checkpoint['params']))
+        init_AM, done = checkpoint['AM'], checkpoint['iteration']
+        print('resuming at iteration {}'.format(done))
+    elif isinstance(init_AM, str):
+        with open(init_AM + '.pickle', 'rb') as handle:
+            init_AM = pickle.load(handle)
 
-    for i in range(0, max_iter):
-        AM = em_step(AM, data[0], data[1])
+    if backend == 'numpy':
+        if is_compiled_corpus(train_dir):
+            corpus = _sparse_from_compiled(train_dir, num_sentences, batch_size)
+        else:
+            data = read_hansard(train_dir, num_sentences)
+            print(len(data[0]))
+            corpus = build_sparse_corpus(data[0], data[1])
+        if init_AM is None:
+            t = initialize_sparse(corpus)
+        elif done:
+            # resuming: continue from exactly the checkpointed pairs, pruned or not
+            t, corpus = table_from_AM(init_AM, corpus)
+        else:
+            t = warm_start_sparse(init_AM, corpus)
+
+        track = tol is not None or callback is not None or log_file is not None
+        pruned = False
+        em = ShardedEM(corpus, workers) if workers > 1 else None
+        try:
+            for i in range(done, max_iter):
+                start = time.perf_counter()
+                previous = t
+                t = em.step(t) if em is not None else em_step_sparse(t, corpus)
+                pruned = False
+                if track and _converged(iteration_metrics(
+                        i, start, previous, t, lambda: log_likelihood_sparse(t, corpus), callback, log_file), tol):
+                    break
+                if pruning and _prune_due(i, prune_at):
+                    previous_corpus = corpus
+                    t, corpus = prune_sparse(t, corpus, prune_threshold, prune_top_k)
+                    pruned = True
+                    if em is not None and corpus is not previous_corpus:
+                        # the shards hold the old pairs
+                        em.close()
+                        em = ShardedEM(corpus, workers)
+                if _checkpoint_due(i, max_iter, checkpoint_every):
+                    save_checkpoint(fn_AM, sparse_to_AM(t, corpus), i + 1, params)
+        finally:
+            if em is not None:
+                em.close()
+
+        if pruning and not pruned:
+            t, corpus = prune_sparse(t, corpus, prune_threshold, prune_top_k)
+        AM = sparse_to_AM(t, corpus)
+    elif backend == 'python':
+        data = read_hansard(train_dir, num_sentences)
+        print(len(data[0]))
+
+        if init_AM is None:
+            AM = initialize(data[0], data[1])
+        elif done:
+            AM = {english_word: dict(translations) for english_word, translations in init_AM.items()}
+        else:
+            AM = warm_start(init_AM, data[0], data[1])
+
+        track = tol is not None or callback is not None or log_file is not None
+        pruned = False
+        for i in range(done, max_iter):
+            start = time.perf_counter()
+            # em_step updates AM in place, keep the previous probabilities
+            previous = _table_values(AM) if track else None
+            AM = em_step(AM, data[0], data[1])
+            pruned = False
+            if track and _converged(iteration_metrics(
+                    i, start, previous, _table_values(AM), lambda: log_likelihood(AM, data[0], data[1]),
+                    callback, log_file), tol):
+                break
+            if pruning and _prune_due(i, prune_at):
+                AM = prune(AM, prune_threshold, prune_top_k)
+                pruned = True
+            if _checkpoint_due(i, max_iter, checkpoint_every):
+                save_checkpoint(fn_AM, AM, i + 1, params)
+
+        if pruning and not pruned:
+            AM = prune(AM, prune_threshold, prune_top_k)
+    else:
+        raise ValueError("Unknown backend '{}'".format(backend))
 
     with open(fn_AM + '.pickle', 'wb') as handle:
         pickle.dump(AM, handle, protocol=pickle.HIGHEST_PROTOCOL)
 
+    if os.path.exists(fn_AM + '.checkpoint.pickle'):
+        os.remove(fn_AM + '.checkpoint.pickle')
+
     # Iterate between E and M steps
     return AM
 
 
 # ------------ Support functions --------------
+@instrumented('read_hansard', items=lambda args, result: len(result[0]))
 def read_hansard(train_dir, num_sentences):
     """
     Read up to num_sentences from train_dir.
@@ -57,34 +183,114 @@ def read_hansard(train_dir, num_sentences):
     Remember that the i^th line in fubar.e corresponds to the i^th line in fubar.f.
 
     Make sure to read the files in an aligned manner.
-    """
-    i = 0
 
-    sentence_list = []
+    Stops early if train_dir holds fewer than num_sentences pairs. train_dir may
+    also be a corpus compiled by hansard_corpus.compile_hansard.
+    """
     english_list = []
     french_list = []
 
-    while i != num_sentences:
-        for file in os.listdir(train_dir):
-            if file[-1] == 'e' and 'Task5' not in file:
-                english_file = open(train_dir + file, 'r')
-                english_lines = english_file.read().splitlines()
-                french_file = open(train_dir + file[:-1] + 'f', 'r')
-                french_lines = french_file.read().splitlines()
-                j = 0
-                while i != num_sentences and j < len(french_lines):
-                    english_list.append(preprocess(english_lines[j], 'e').split(' '))
-                    french_list.append(preprocess(french_lines[j], 'f').split(' '))
-                    j += 1
-                    i += 1
-        english_file.close()
-        french_file.close()
-    sentence_list.append(english_list)
-    sentence_list.append(french_list)
-
-    return sentence_list
+    if is_compiled_corpus(train_dir):
+        for english_batch, french_batch in iter_sentence_pairs(open_hansard(train_dir), num_sentences):
+            english_list.extend(english_batch)
+            french_list.extend(french_batch)
+
+        return [english_list, french_list]
+
+    i = 0
+
+    for file in os.listdir(train_dir):
+        if i == num_sentences:
+            break
+        if file[-1] == 'e' and 'Task5' not in file:
+            english_lines = preprocess_file(train_dir + file, 'e', splitlines=True)
+            french_lines = preprocess_file(train_dir + file[:-1] + 'f', 'f', splitlines=True)
+            j = 0
+            while i != num_sentences and j < len(french_lines):
+                english_list.append(english_lines[j])
+                french_list.append(french_lines[j])
+                j += 1
+                i += 1
+
+    return [english_list, french_list]
+
+
+def _sparse_from_compiled(corpus_dir, num_sentences, batch_size):
+    """
+    Build the numpy backend's corpus straight from the memory-mapped id arrays of
+    a compiled corpus, streaming it if batch_size is given.
+    """
+    hansard = open_hansard(corpus_dir)
+    n = min(num_sentences, hansard['num_sentences'])
+    e, f = hansard['e'], hansard['f']
+    arrays = (e['ids'], e['offsets'][:n + 1], f['ids'], f['offsets'][:n + 1], e['vocab'], f['vocab'])
+    print(n)
+
+    if batch_size is None:
+        return build_sparse_corpus_from_ids(*arrays)
+
+    return build_streaming_corpus(*arrays, batch_size)
+
+
+def save_checkpoint(fn_AM, AM, iteration, params):
+    """
+    Save the AM after `iteration` EM iterations to fn_AM + '.checkpoint.pickle'.
+    The file is written under a temporary name and renamed, so an interrupted
+    save leaves the previous checkpoint intact.
+    """
+    tmp = '{}.checkpoint.{}.tmp'.format(fn_AM, os.getpid())
+    with open(tmp, 'wb') as handle:
+        pickle.dump({'AM': AM, 'iteration': iteration, 'params': params}, handle, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, fn_AM + '.checkpoint.pickle')
+
+
+def iteration_metrics(i, start, previous, t, likelihood, callback=None, log_file=None):
+    """
+    Measure EM iteration i, which started at time.perf_counter() start and changed
+    the probabilities from previous to t (arrays in the same order), and report the
+    metrics to callback and log_file. The corpus log-likelihood is only computed,
+    with likelihood(), when the metrics are reported.
+    """
+    change = np.abs(t - previous)
+    metrics = {
+        'iteration': i + 1,
+        'seconds': time.perf_counter() - start,
+        'table_size': len(t),
+        'max_change': float(change.max()) if len(change) else 0.0,
+        'mean_change': float(change.mean()) if len(change) else 0.0,
+    }
+
+    if callback is not None or log_file is not None:
+        metrics['log_likelihood'] = likelihood()
+        if callback is not None:
+            callback(metrics)
+        if log_file is not None:
+            with open(log_file, 'a') as handle:
+                handle.write(json.dumps(metrics) + '\n')
+
+    return metrics
 
 
+def _prune_due(i, prune_at):
+    return prune_at is None or i + 1 in prune_at
+
+
+def _converged(metrics, tol):
+    if tol is not None and metrics['max_change'] <= tol:
+        print('converged after {} iterations'.format(metrics['iteration']))
+        return True
+    return False
+
+
+def _table_values(t):
+    return np.fromiter((prob for translations in t.values() for prob in translations.values()), dtype=np.float64)
+
+
+def _checkpoint_due(i, max_iter, checkpoint_every):
+    return checkpoint_every is not None and (i + 1) % checkpoint_every == 0 and i + 1 < max_iter
+
+
+@instrumented('initialize', items=lambda args, result: len(args[0]))
 def initialize(eng, fre):
     """
     Initialize alignment model uniformly.
@@ -115,6 +321,72 @@ def initialize(eng, fre):
 
     return AM
 
+def log_likelihood(t, eng, fre):
+    """
+    The log-likelihood of the corpus under the alignment model, up to the constant
+    length terms: the sum over every French token of log sum_e t[e][f], summing over
+    the English tokens of its sentence. Tokens left without any pair by pruning are
+    skipped.
+    """
+    total = 0
+    for index in range(len(eng)):
+        for french_word in fre[index]:
+            prob = sum(t[english_word].get(french_word, 0) for english_word in eng[index])
+            if prob > 0:
+                total += log(prob)
+    return total
+
+
+def prune(t, threshold=None, top_k=None):
+    """
+    Prune the alignment model: for every English word, drop the French words whose
+    probability is below threshold or that are not among its top_k most probable
+    (ties are broken by the French word). The most probable French word is always
+    kept. Words that lost pairs are renormalized to sum to 1.
+    """
+    for english_word, translations in t.items():
+        ranked = sorted(translations.items(), key=lambda item: (-item[1], item[0]))
+        kept = [(french_word, prob) for rank, (french_word, prob) in enumerate(ranked)
+                if rank == 0 or (prob > 0 and (threshold is None or prob >= threshold)
+                                 and (top_k is None or rank < top_k))]
+
+        if len(kept) < len(translations):
+            total = sum(prob for french_word, prob in kept)
+            t[english_word] = {french_word: prob / total for french_word, prob in kept}
+
+    return t
+
+
+def warm_start(AM, eng, fre):
+    """
+    Initialize the alignment model from a trained AM for a (possibly larger) corpus.
+    Pairs the AM already has keep their probability; English words the AM has never
+    seen get the uniform initialization of initialize. An English word that gains new
+    pairs gets them at its uniform value and is renormalized so its row sums to 1.
+    Pairs that do not co-occur in the corpus are dropped.
+    """
+    t = initialize(eng, fre)
+
+    for english_word in t:
+        known = AM.get(english_word)
+        if not known:
+            continue
+
+        new_pairs = False
+        for french_word in t[english_word]:
+            if french_word in known:
+                t[english_word][french_word] = known[french_word]
+            else:
+                new_pairs = True
+
+        if new_pairs:
+            total = sum(t[english_word].values())
+            for french_word in t[english_word]:
+                t[english_word][french_word] /= total
+
+    return t
+
+@instrumented('em_step', items=lambda args, result: len(args[1]))
 def em_step(t, eng, fre):
     """
     One step in the EM algorithm.
@@ -129,7 +401,8 @@ def em_step(t, eng, fre):
                 t_count[english_word] = dict()
 
             for french_word in fre[index]:
-                t_count[english_word][french_word] = 0
+                if french_word in t[english_word]:
+                    t_count[english_word][french_word] = 0
         for english_word in eng[index]:
             total[english_word] = 0
 
@@ -138,8 +411,13 @@ def em_step(t, eng, fre):
             denom_c = 0
             f_count = fre[index].count(french_word)
             for english_word in eng[index]:
-                denom_c += t[english_word][french_word] * f_count
+                denom_c += t[english_word].get(french_word, 0) * f_count
+            if denom_c == 0:
+                # every pair of this French word was pruned
+                continue
             for english_word in eng[index]:
+                if french_word not in t[english_word]:
+                    continue
                 e_count = eng[index].count(english_word)
                 t_count[english_word][french_word] += t[english_word][french_word] * f_count * e_count / denom_c
                 total[english_word] += t[english_word][french_word] * f_count * e_count / denom_c
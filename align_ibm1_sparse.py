@@ -0,0 +1,472 @@
+import numpy as np
+from multiprocessing import Pool
+from multiprocessing.shared_memory import SharedMemory
+from instrumentation import *
+
+
+def build_sparse_corpus(eng, fre):
+    """
+    Map the tokenized sentence pairs to integer ids and precompute the sparse
+    co-occurrence structure used by the vectorized EM engine.
+
+    INPUTS:
+    eng :   (list) English sentences, each a list of tokens (as from read_hansard)
+    fre :   (list) French sentences, each a list of tokens (as from read_hansard)
+
+    OUTPUT:
+    corpus : (dictionary) with the fields
+             'e_vocab', 'f_vocab' : id -> word lists
+             'pair_e', 'pair_f'   : English/French id of every co-occurring pair,
+                                    sorted by English id then French id
+             'pair_idx'           : pair index of every (sentence, e, f) triple
+             'group'              : index of the (sentence, f) group of every triple
+             'weight'             : count of e in the sentence, per triple
+             'coef'               : count(f) * count(e) ** 2, per triple
+             'num_groups'         : number of (sentence, f) groups
+             'offsets'            : sentence i owns triples offsets[i]:offsets[i + 1]
+    """
+    e_ids, e_offsets, e_vocab = _to_ids(eng)
+    f_ids, f_offsets, f_vocab = _to_ids(fre)
+
+    return build_sparse_corpus_from_ids(e_ids, e_offsets, f_ids, f_offsets, e_vocab, f_vocab)
+
+
+def build_sparse_corpus_from_ids(e_ids, e_offsets, f_ids, f_offsets, e_vocab, f_vocab):
+    """
+    Same as build_sparse_corpus, for sentences already given as flat id arrays.
+    Sentence i spans ids[offsets[i]:offsets[i + 1]].
+    """
+    n_f = len(f_vocab)
+    keys, group, weight, coef, offsets = sentence_triples(e_ids, e_offsets, f_ids, f_offsets, n_f)
+
+    pair_keys, pair_idx = np.unique(keys, return_inverse=True)
+
+    return {
+        'e_vocab': e_vocab,
+        'f_vocab': f_vocab,
+        'pair_e': pair_keys // n_f,
+        'pair_f': pair_keys % n_f,
+        'pair_idx': pair_idx.reshape(-1),
+        'group': group,
+        'weight': weight,
+        'coef': coef,
+        'num_groups': int(group.max()) + 1 if len(group) else 0,
+        'offsets': offsets,
+    }
+
+
+def sentence_triples(e_ids, e_offsets, f_ids, f_offsets, n_f, lo=0, hi=None):
+    """
+    Expand sentences lo..hi into one entry per (sentence, unique e, unique f).
+    Returns the pair keys (e * n_f + f), the (sentence, f) group of every entry
+    (numbered from 0 within the range), the per-entry weight and coef, and the
+    offset of every sentence's first entry.
+    """
+    if hi is None:
+        hi = len(e_offsets) - 1
+
+    keys, group, weight, coef = [], [], [], []
+    offsets = [0]
+    num_groups = 0
+
+    for s in range(lo, hi):
+        ue, ce = np.unique(e_ids[e_offsets[s]:e_offsets[s + 1]], return_counts=True)
+        uf, cf = np.unique(f_ids[f_offsets[s]:f_offsets[s + 1]], return_counts=True)
+
+        keys.append((ue[:, None].astype(np.int64) * n_f + uf[None, :]).reshape(-1))
+        group.append(np.tile(np.arange(num_groups, num_groups + len(uf)), len(ue)))
+        w = np.repeat(ce, len(uf)).astype(np.float64)
+        weight.append(w)
+        coef.append(np.tile(cf, len(ue)) * w * w)
+        num_groups += len(uf)
+        offsets.append(offsets[-1] + len(ue) * len(uf))
+
+    offsets = np.array(offsets, dtype=np.int64)
+
+    if not keys:
+        empty = np.zeros(0, dtype=np.float64)
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), empty, empty, offsets
+
+    return (np.concatenate(keys), np.concatenate(group), np.concatenate(weight),
+            np.concatenate(coef), offsets)
+
+
+def build_streaming_corpus(e_ids, e_offsets, f_ids, f_offsets, e_vocab, f_vocab, batch_size):
+    """
+    Like build_sparse_corpus_from_ids, but only the pair table is held in memory.
+    The id arrays (typically memory mapped from a compiled corpus, see hansard_corpus)
+    are re-read batch_size sentences at a time by every em_step_sparse, so memory
+    grows with the batch and the number of pairs, not with the corpus.
+    """
+    n_f = len(f_vocab)
+    pair_keys = np.zeros(0, dtype=np.int64)
+
+    for lo in range(0, len(e_offsets) - 1, batch_size):
+        hi = min(lo + batch_size, len(e_offsets) - 1)
+        keys = sentence_triples(e_ids, e_offsets, f_ids, f_offsets, n_f, lo, hi)[0]
+        pair_keys = np.union1d(pair_keys, keys)
+
+    return {
+        'e_vocab': e_vocab,
+        'f_vocab': f_vocab,
+        'pair_e': pair_keys // n_f,
+        'pair_f': pair_keys % n_f,
+        'pair_keys': pair_keys,
+        'stream': (e_ids, e_offsets, f_ids, f_offsets),
+        'batch_size': batch_size,
+    }
+
+
+@instrumented('initialize_sparse', items=lambda args, result: len(result))
+def initialize_sparse(corpus):
+    """
+    Initialize the translation table uniformly over the co-occurring pairs,
+    mirroring align_ibm1.initialize.
+    """
+    pair_e = corpus['pair_e']
+    pair_f = corpus['pair_f']
+
+    mapping_size = np.bincount(pair_e, minlength=len(corpus['e_vocab']))
+    t = 1 / np.maximum(mapping_size[pair_e] - 2, 1).astype(np.float64)
+
+    for token in ('SENTSTART', 'SENTEND'):
+        if token in corpus['e_vocab'] and token in corpus['f_vocab']:
+            same = (pair_e == corpus['e_vocab'].index(token)) & (pair_f == corpus['f_vocab'].index(token))
+            t[same] = 1
+
+    return t
+
+
+def warm_start_sparse(AM, corpus):
+    """
+    Initialize the translation table from a trained AM, mirroring
+    align_ibm1.warm_start.
+    """
+    t = initialize_sparse(corpus)
+    pair_e = corpus['pair_e']
+
+    probs, known = _lookup_AM(AM, corpus)
+    t[known] = probs[known]
+
+    num_english = len(corpus['e_vocab'])
+    mixed = (np.bincount(pair_e, weights=known, minlength=num_english) > 0) & \
+            (np.bincount(pair_e, weights=~known, minlength=num_english) > 0)
+    total = np.bincount(pair_e, weights=t, minlength=num_english)
+
+    return np.where(mixed[pair_e], t / total[pair_e], t)
+
+
+def table_from_AM(AM, corpus):
+    """
+    The translation table holding exactly the pairs of AM (e.g. a pruned checkpoint),
+    and the corpus restricted to them.
+    """
+    probs, known = _lookup_AM(AM, corpus)
+
+    return restrict_sparse(probs, corpus, known)
+
+
+def prune_sparse(t, corpus, threshold=None, top_k=None):
+    """
+    Prune the translation table like align_ibm1.prune. Returns the pruned table and
+    the corpus restricted to the remaining pairs.
+    """
+    pair_e = corpus['pair_e']
+    num_english = len(corpus['e_vocab'])
+
+    # nothing to drop: skip ranking the pairs
+    if len(t) == 0 or ((t > 0).all() and (threshold is None or (t >= threshold).all()) and
+                       (top_k is None or np.bincount(pair_e, minlength=num_english).max() <= top_k)):
+        return t, corpus
+
+    f_rank = np.argsort(np.argsort(np.array(corpus['f_vocab'], dtype=object), kind='stable'))
+
+    # rank of every pair within its English word, by decreasing probability then French word
+    order = np.lexsort((f_rank[corpus['pair_f']], -t, pair_e))
+    rank = np.empty(len(t), dtype=np.int64)
+    rank[order] = np.arange(len(t)) - np.searchsorted(pair_e[order], pair_e[order])
+
+    keep = t > 0
+    if threshold is not None:
+        keep &= t >= threshold
+    if top_k is not None:
+        keep &= rank < top_k
+    keep |= rank == 0
+    if keep.all():
+        return t, corpus
+
+    lost = np.bincount(pair_e, weights=~keep, minlength=num_english) > 0
+    t, corpus = restrict_sparse(t, corpus, keep)
+    total = np.bincount(corpus['pair_e'], weights=t, minlength=num_english)
+
+    return np.where(lost[corpus['pair_e']], t / total[corpus['pair_e']], t), corpus
+
+
+def restrict_sparse(t, corpus, keep):
+    """
+    Drop the pairs where keep is False from the table and the corpus. Their triples
+    are removed too; a French word left without pairs in a sentence no longer takes
+    part in EM.
+    """
+    restricted = dict(corpus)
+    restricted['pair_e'] = corpus['pair_e'][keep]
+    restricted['pair_f'] = corpus['pair_f'][keep]
+
+    if 'stream' in corpus:
+        restricted['pair_keys'] = corpus['pair_keys'][keep]
+    else:
+        triples = keep[corpus['pair_idx']]
+        restricted['pair_idx'] = (np.cumsum(keep) - 1)[corpus['pair_idx'][triples]]
+        for field in ('group', 'weight', 'coef'):
+            restricted[field] = corpus[field][triples]
+        restricted['offsets'] = np.concatenate(([0], np.cumsum(triples)))[corpus['offsets']]
+
+    return t[keep], restricted
+
+
+def expected_counts(t, pair_idx, group, weight, coef, num_groups, num_pairs):
+    """
+    E-step over a block of triples. Returns the expected count of every pair.
+    """
+    t_triple = t[pair_idx]
+    denom = np.bincount(group, weights=weight * t_triple, minlength=num_groups)
+
+    return np.bincount(pair_idx, weights=coef * t_triple / denom[group], minlength=num_pairs)
+
+
+def maximize(t_count, pair_e, num_english):
+    """
+    M-step: normalize the expected counts per English word.
+    """
+    total = np.bincount(pair_e, weights=t_count, minlength=num_english)
+
+    return t_count / total[pair_e]
+
+
+@instrumented('em_step_sparse', items=lambda args, result: len(result))
+def em_step_sparse(t, corpus):
+    """
+    One step in the EM algorithm, as batched array operations.
+    Computes the same update as align_ibm1.em_step.
+    """
+    if 'stream' in corpus:
+        t_count = _streamed_counts(t, corpus)
+    else:
+        t_count = expected_counts(t, corpus['pair_idx'], corpus['group'], corpus['weight'],
+                                  corpus['coef'], corpus['num_groups'], len(t))
+
+    return maximize(t_count, corpus['pair_e'], len(corpus['e_vocab']))
+
+
+def log_likelihood_sparse(t, corpus):
+    """
+    The corpus log-likelihood of align_ibm1.log_likelihood, from the sparse table.
+    """
+    if 'stream' not in corpus:
+        return group_log_likelihood(t, corpus['pair_idx'], corpus['group'], corpus['weight'], corpus['coef'],
+                                    corpus['num_groups'])
+
+    total = 0.0
+    for pair_idx, group, weight, coef, num_groups in _stream_batches(corpus):
+        total += group_log_likelihood(t, pair_idx, group, weight, coef, num_groups)
+
+    return total
+
+
+def group_log_likelihood(t, pair_idx, group, weight, coef, num_groups):
+    """
+    Log-likelihood of a block of triples: every (sentence, f) group contributes
+    count(f) * log(sum_e count(e) * t[e, f]).
+    """
+    denom = np.bincount(group, weights=weight * t[pair_idx], minlength=num_groups)
+    f_count = np.zeros(num_groups)
+    f_count[group] = coef / (weight * weight)
+    # groups whose pairs were all pruned have no triples left
+    present = denom > 0
+
+    return float(np.dot(f_count[present], np.log(denom[present])))
+
+
+class ShardedEM:
+    """
+    Runs em_step_sparse across a process pool. The sentence pairs are split into
+    one shard per worker; every iteration each worker computes the expected counts
+    of its shard from the shared translation table, and the parent merges the
+    partial counts and performs the M-step.
+
+    Use as a context manager so the pool and the shared table are released:
+
+        with ShardedEM(corpus, workers=8) as em:
+            for i in range(max_iter):
+                t = em.step(t)
+    """
+
+    def __init__(self, corpus, workers):
+        if 'stream' in corpus:
+            raise ValueError('ShardedEM needs an in-memory corpus from build_sparse_corpus')
+
+        self.corpus = corpus
+        self.num_pairs = len(corpus['pair_e'])
+        self.shared = SharedMemory(create=True, size=max(self.num_pairs, 1) * 8)
+        self.t = np.ndarray((self.num_pairs,), dtype=np.float64, buffer=self.shared.buf)
+        self.shards = _make_shards(corpus, workers)
+        self.pool = Pool(len(self.shards), initializer=_init_worker,
+                         initargs=(self.shared.name, self.num_pairs, self.shards))
+
+    def step(self, t):
+        """
+        One step in the EM algorithm. Returns the updated table.
+        """
+        self.t[:] = t
+        t_count = np.zeros(self.num_pairs, dtype=np.float64)
+
+        for k, partial in enumerate(self.pool.map(_shard_counts, range(len(self.shards)))):
+            t_count[self.shards[k]['pairs']] += partial
+
+        return maximize(t_count, self.corpus['pair_e'], len(self.corpus['e_vocab']))
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        del self.t
+        self.shared.close()
+        self.shared.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def sparse_to_AM(t, corpus):
+    """
+    Convert the sparse translation table back to the AM dictionary of dictionaries.
+    """
+    AM = dict()
+    e_vocab = corpus['e_vocab']
+    f_vocab = corpus['f_vocab']
+
+    pair_e = corpus['pair_e'].tolist()
+    pair_f = corpus['pair_f'].tolist()
+
+    for e, f, prob in zip(pair_e, pair_f, t.tolist()):
+        english_word = e_vocab[e]
+        if english_word not in AM:
+            AM[english_word] = dict()
+        AM[english_word][f_vocab[f]] = prob
+
+    return AM
+
+
+def _streamed_counts(t, corpus):
+    t_count = np.zeros(len(t), dtype=np.float64)
+
+    for pair_idx, group, weight, coef, num_groups in _stream_batches(corpus):
+        t_count += expected_counts(t, pair_idx, group, weight, coef, num_groups, len(t))
+
+    return t_count
+
+
+def _stream_batches(corpus):
+    """
+    Yield the triples of a streaming corpus batch by batch, leaving out pruned pairs.
+    """
+    e_ids, e_offsets, f_ids, f_offsets = corpus['stream']
+    n_f = len(corpus['f_vocab'])
+    num_sentences = len(e_offsets) - 1
+    pair_keys = corpus['pair_keys']
+
+    for lo in range(0, num_sentences, corpus['batch_size']):
+        hi = min(lo + corpus['batch_size'], num_sentences)
+        keys, group, weight, coef, _ = sentence_triples(e_ids, e_offsets, f_ids, f_offsets, n_f, lo, hi)
+        pair_idx = np.searchsorted(pair_keys, keys)
+
+        found = pair_keys[np.minimum(pair_idx, len(pair_keys) - 1)] == keys
+        if not found.all():
+            pair_idx, group, weight, coef = pair_idx[found], group[found], weight[found], coef[found]
+        if len(pair_idx) == 0:
+            continue
+        yield pair_idx, group, weight, coef, int(group.max()) + 1
+
+
+def _lookup_AM(AM, corpus):
+    """
+    The probability AM gives every pair of the corpus, and whether it has the pair.
+    """
+    e_vocab = corpus['e_vocab']
+    f_vocab = corpus['f_vocab']
+    probs = np.zeros(len(corpus['pair_e']), dtype=np.float64)
+    known = np.zeros(len(corpus['pair_e']), dtype=bool)
+
+    for k, (e, f) in enumerate(zip(corpus['pair_e'].tolist(), corpus['pair_f'].tolist())):
+        prob = AM.get(e_vocab[e], {}).get(f_vocab[f])
+        if prob is not None:
+            probs[k] = prob
+            known[k] = True
+
+    return probs, known
+
+
+def _to_ids(sentences):
+    """
+    Assign ids to the words of a list of tokenized sentences, in order of
+    first appearance. Returns the flat id array, the sentence offsets and the vocabulary.
+    """
+    vocab = dict()
+    ids = []
+    offsets = [0]
+
+    for sentence in sentences:
+        for word in sentence:
+            if word not in vocab:
+                vocab[word] = len(vocab)
+            ids.append(vocab[word])
+        offsets.append(len(ids))
+
+    return np.array(ids, dtype=np.int64), np.array(offsets, dtype=np.int64), list(vocab)
+
+
+# ------------ Worker support for ShardedEM --------------
+_worker = dict()
+
+
+def _make_shards(corpus, workers):
+    """
+    Split the triples at sentence boundaries into at most `workers` shards of
+    roughly equal size. Pair indices are made local to each shard so workers only
+    send back the counts of the pairs they saw.
+    """
+    offsets = corpus['offsets']
+    targets = np.linspace(0, offsets[-1], workers + 1)[1:-1]
+    bounds = np.unique(np.concatenate(([0], offsets[np.searchsorted(offsets, targets)], [offsets[-1]])))
+
+    shards = []
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        group = corpus['group'][lo:hi]
+        pairs, local_idx = np.unique(corpus['pair_idx'][lo:hi], return_inverse=True)
+        shards.append({
+            'pairs': pairs,
+            'pair_idx': local_idx.reshape(-1),
+            'group': group - group.min(),
+            'weight': corpus['weight'][lo:hi],
+            'coef': corpus['coef'][lo:hi],
+            'num_groups': int(group.max() - group.min()) + 1,
+        })
+
+    return shards
+
+
+def _init_worker(shared_name, num_pairs, shards):
+    shared = SharedMemory(name=shared_name)
+    _worker['shared'] = shared
+    _worker['t'] = np.ndarray((num_pairs,), dtype=np.float64, buffer=shared.buf)
+    _worker['shards'] = shards
+
+
+def _shard_counts(k):
+    shard = _worker['shards'][k]
+    t = _worker['t'][shard['pairs']]
+
+    return expected_counts(t, shard['pair_idx'], shard['group'], shard['weight'],
+                           shard['coef'], shard['num_groups'], len(t))
@@ -0,0 +1,321 @@
+from preprocess import *
+from lm_train import *
+from perplexity import *
+from align_ibm1 import *
+from BLEU_score import *
+from instrumentation import *
+import preprocess_cache
+import decode
+import numpy as np
+import tracemalloc
+import platform
+import tempfile
+import shutil
+import time
+import json
+import os
+
+BENCHMARK_VERSION = 1
+
+
+def generate_hansard(out_dir, num_sentences, vocab_size=5000, seed=0, zipf=1.1, sentences_per_file=1000,
+                     num_test=25):
+    """
+    Write a synthetic parallel corpus shaped like the Hansard data.
+
+    INPUTS:
+    out_dir :               (string) where to create the 'Training/' and 'Testing/' directories
+    num_sentences :         (int) the number of training sentence pairs
+    vocab_size :            (int) the number of English (and French) words
+    seed :                  (int) the corpus only depends on the seed and the sizes
+    zipf :                  (float) word ranks are drawn with probability proportional to rank ** -zipf
+    sentences_per_file :    (int) sentence pairs per .e/.f file
+    num_test :              (int) the number of Task5 test sentences
+
+    OUTPUT:
+    train_dir, test_dir :   (string) the two directories, ending with '/' as the
+                            rest of the code expects
+
+    Every English word has a fixed French translation. French sentences translate
+    their English sentence word by word, with some adjacent words swapped, and
+    elide 'le'/'la' before vowels, so preprocess, the LM and the AM all have
+    realistic work to do. Testing/ holds Task5.f, Task5.e, Task5.google.e and
+    held-out .e/.f files for preplexity.
+    """
+    rng = np.random.default_rng(seed)
+    english = _make_words(rng, vocab_size)
+    french = _make_words(rng, vocab_size)
+    french[:2] = ['le', 'la']
+    weights = np.arange(1, vocab_size + 1, dtype=np.float64) ** -zipf
+    weights /= weights.sum()
+
+    train_dir = os.path.join(out_dir, 'Training') + '/'
+    test_dir = os.path.join(out_dir, 'Testing') + '/'
+    os.makedirs(train_dir, exist_ok=True)
+    os.makedirs(test_dir, exist_ok=True)
+
+    def write_pairs(prefix, count):
+        pairs = [_sentence_pair(rng, english, french, weights) for _ in range(count)]
+        with open(prefix + '.e', 'w') as e_file, open(prefix + '.f', 'w') as f_file:
+            for e_sentence, f_sentence in pairs:
+                e_file.write(e_sentence + '\n')
+                f_file.write(f_sentence + '\n')
+        return pairs
+
+    for k, start in enumerate(range(0, num_sentences, sentences_per_file)):
+        write_pairs(os.path.join(train_dir, 'hansard.{:04d}'.format(k)), min(sentences_per_file,
+                                                                              num_sentences - start))
+
+    write_pairs(os.path.join(test_dir, 'hansard.test'), max(num_sentences // 10, num_test))
+    pairs = write_pairs(os.path.join(test_dir, 'Task5'), num_test)
+    with open(os.path.join(test_dir, 'Task5.google.e'), 'w') as handle:
+        for e_sentence, f_sentence in pairs:
+            words = e_sentence.split(' ')
+            handle.write(' '.join(words[:-2] + [words[-1]]) + '\n')
+
+    return train_dir, test_dir
+
+
+def run_benchmarks(scales, work_dir=None, vocab_size=5000, seed=0, max_iter=5, repeat=1, memory=True,
+                   backends=('python', 'numpy')):
+    """
+    Time the hot paths of the pipeline on synthetic corpora of every scale.
+
+    INPUTS:
+    scales :        (list) numbers of training sentences
+    work_dir :      (string) where to generate the corpora and models, a temporary
+                    directory by default
+    vocab_size :    (int) see generate_hansard
+    seed :          (int) see generate_hansard
+    max_iter :      (int) EM iterations of align_ibm1
+    repeat :        (int) runs of every stage; the fastest is reported
+    memory :        (boolean) run every stage once more under tracemalloc to record
+                    its peak memory
+    backends :      (list) the align_ibm1 backends to time
+
+    OUTPUT:
+    results :       (dictionary) 'meta' describes the run, 'results'[scale][stage]
+                    holds 'seconds' (the fastest run), 'runs', 'items' (the amount
+                    of work, e.g. sentences) and 'peak_bytes'. align_ibm1 stages also
+                    hold 'iteration_seconds', the mean time of an EM iteration, and
+                    'iterations', the EM iterations of a run.
+
+    The preprocessing cache is disabled, so every stage does its full work.
+    Instrumentation is turned on while the benchmarks run, to time the EM iterations
+    without the telemetry of align_ibm1's callback.
+    """
+    cleanup = work_dir is None
+    if work_dir is None:
+        work_dir = tempfile.mkdtemp(prefix='smt-benchmark-')
+    cache_dir = preprocess_cache.CACHE_DIR
+    preprocess_cache.CACHE_DIR = ''
+    instrumented_before = instrumentation_enabled()
+    enable_instrumentation(report_at_exit=False)
+
+    results = {}
+    try:
+        for scale in scales:
+            print('scale: {} sentences'.format(scale))
+            results[str(scale)] = _run_scale(os.path.join(work_dir, str(scale)), scale, vocab_size, seed, max_iter,
+                                             repeat, memory, backends)
+    finally:
+        preprocess_cache.CACHE_DIR = cache_dir
+        if not instrumented_before:
+            disable_instrumentation()
+        if cleanup:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {'meta': {'version': BENCHMARK_VERSION, 'python': platform.python_version(), 'numpy': np.__version__,
+                     'machine': platform.machine(), 'cpus': os.cpu_count(), 'vocab_size': vocab_size,
+                     'seed': seed, 'max_iter': max_iter, 'repeat': repeat,
+                     'date': time.strftime('%Y-%m-%dT%H:%M:%S')},
+            'results': results}
+
+
+def compare(results, baseline, tolerance=0.2, min_seconds=0.01):
+    """
+    Compare benchmark results against a baseline run.
+
+    OUTPUT:
+    regressions :   (list) a message for every stage that got more than tolerance
+                    (relative) slower than in the baseline. Stages faster than
+                    min_seconds in both runs are ignored, they are mostly noise.
+    """
+    regressions = []
+    for scale, stages in results['results'].items():
+        for stage, measured in stages.items():
+            expected = baseline['results'].get(scale, {}).get(stage)
+            if expected is None or max(measured['seconds'], expected['seconds']) < min_seconds:
+                continue
+            ratio = measured['seconds'] / expected['seconds'] if expected['seconds'] > 0 else float('inf')
+            if ratio > 1 + tolerance:
+                regressions.append('{} sentences, {}: {:.4f}s vs {:.4f}s in the baseline ({:+.0%})'.format(
+                    scale, stage, measured['seconds'], expected['seconds'], ratio - 1))
+    return regressions
+
+
+# ------------ Support functions --------------
+def _run_scale(out_dir, scale, vocab_size, seed, max_iter, repeat, memory, backends):
+    train_dir, test_dir = generate_hansard(out_dir, scale, vocab_size, seed)
+    stages = {}
+    state = {}
+
+    def stage(name, function, items):
+        stages[name] = _measure(function, items, repeat, memory)
+        print('  {}: {:.4f}s'.format(name, stages[name]['seconds']))
+
+    lines = {}
+    for language in ('e', 'f'):
+        lines[language] = []
+        for file in sorted(os.listdir(train_dir)):
+            if file[-1] == language:
+                with open(train_dir + file, 'r') as data:
+                    lines[language].extend(data.read().splitlines())
+
+    stage('preprocess', lambda: [list(preprocess_many(lines[language], language)) for language in ('e', 'f')],
+          len(lines['e']) + len(lines['f']))
+
+    def train_lm():
+        state['LM'] = lm_train(train_dir, 'e', os.path.join(out_dir, 'LM'))
+    stage('lm_train', train_lm, len(lines['e']))
+
+    test_sentences = len(read_test_corpus(test_dir, 'e'))
+    stage('preplexity', lambda: preplexity(state['LM'], test_dir, 'e'), test_sentences)
+    stage('preplexity_smoothed', lambda: preplexity(state['LM'], test_dir, 'e', True, 0.1), test_sentences)
+
+    for backend in backends:
+        # the EM steps are timed by the instrumentation, a callback would turn on the telemetry
+        step = 'em_step' if backend == 'python' else 'em_step_sparse'
+        em_runs = []
+
+        def train_am():
+            calls, seconds = _stage_totals(step)
+            state['AM'] = align_ibm1(train_dir, scale, max_iter, os.path.join(out_dir, 'AM'), backend=backend)
+            new_calls, new_seconds = _stage_totals(step)
+            em_runs.append((new_calls - calls, new_seconds - seconds))
+        stage('align_ibm1_' + backend, train_am, scale)
+
+        # only the timed runs, not the one under tracemalloc that follows them
+        calls = sum(run[0] for run in em_runs[:repeat])
+        seconds = sum(run[1] for run in em_runs[:repeat])
+        stages['align_ibm1_' + backend].update(iterations=calls // repeat, iteration_seconds=seconds / max(calls, 1))
+
+    with open(test_dir + 'Task5.f', 'r') as data:
+        french = [preprocess(line, 'f') for line in data]
+    with open(test_dir + 'Task5.e', 'r') as data:
+        eng = [preprocess(line, 'e') for line in data]
+    with open(test_dir + 'Task5.google.e', 'r') as data:
+        eng_g = [preprocess(line, 'e') for line in data]
+
+    for mode in ('random', 'beam'):
+        def decode_test():
+            # a fresh AM object, so the candidate index is rebuilt as in a new run
+            state['decoded'] = decode.decode_many(french, state['LM'], dict(state['AM']), mode=mode, seed=seed)
+        stage('decode_' + mode, decode_test, len(french))
+
+    def score():
+        for n in (1, 2, 3):
+            for candidate, references in zip(state['decoded'], zip(eng, eng_g)):
+                BLEU_score(candidate, list(references), n, brevity=True)
+    stage('BLEU_score', score, 3 * len(french))
+
+    def score_sentences():
+        from evalAlign import _get_BLEU_scores
+        for n in (1, 2, 3):
+            _get_BLEU_scores(state['decoded'], eng, eng_g, n)
+    stage('_get_BLEU_scores', score_sentences, 3 * len(french))
+
+    return stages
+
+
+def _stage_totals(name):
+    stage = instrumentation_summary()['stages'].get(name)
+    return (0, 0.0) if stage is None else (stage['calls'], stage['seconds'])
+
+
+def _measure(function, items, repeat, memory):
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        runs.append(time.perf_counter() - start)
+
+    result = {'seconds': min(runs), 'runs': runs, 'items': items}
+    if memory:
+        tracemalloc.start()
+        try:
+            function()
+            result['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result
+
+
+_LETTERS = np.array(list('abcdefghijklmnopqrstuvwxyz'))
+_VOWELS = set('aeiou')
+
+
+def _make_words(rng, vocab_size):
+    words = []
+    seen = set()
+    while len(words) < vocab_size:
+        word = ''.join(rng.choice(_LETTERS, size=int(rng.integers(2, 10))))
+        if word not in seen:
+            seen.add(word)
+            words.append(word)
+    return words
+
+
+def _sentence_pair(rng, english, french, weights):
+    ranks = rng.choice(len(english), size=int(rng.integers(4, 25)), p=weights)
+    f_ranks = list(ranks)
+    for i in range(len(f_ranks) - 1):
+        if rng.random() < 0.1:
+            f_ranks[i], f_ranks[i + 1] = f_ranks[i + 1], f_ranks[i]
+
+    e_words = [english[r] for r in ranks]
+    f_words = []
+    for r in f_ranks:
+        word = french[r]
+        if f_words and f_words[-1] in ('le', 'la') and word[0] in _VOWELS:
+            f_words[-1] = "l'" + word
+        else:
+            f_words.append(word)
+
+    end = '?' if rng.random() < 0.1 else '.'
+    if len(e_words) > 6 and rng.random() < 0.5:
+        e_words[3] += ','
+        f_words[min(3, len(f_words) - 1)] += ','
+    return ' '.join(e_words).capitalize() + ' ' + end, ' '.join(f_words).capitalize() + ' ' + end
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline on synthetic Hansard corpora")
+    parser.add_argument('--scales', type=int, nargs='+', default=[1000, 5000, 20000],
+                        help="numbers of training sentences")
+    parser.add_argument('--vocab-size', type=int, default=5000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-iter', type=int, default=5, help="EM iterations of align_ibm1")
+    parser.add_argument('--repeat', type=int, default=1, help="runs per stage, the fastest is reported")
+    parser.add_argument('--backends', nargs='+', default=['python', 'numpy'], choices=['python', 'numpy'])
+    parser.add_argument('--no-memory', action='store_true', help="skip the tracemalloc peak memory runs")
+    parser.add_argument('--work-dir', default=None, help="keep the generated corpora and models here")
+    parser.add_argument('--output', default='benchmark.json', help="where to write the results")
+    parser.add_argument('--baseline', default=None, help="results to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed relative slowdown")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.scales, args.work_dir, args.vocab_size, args.seed, args.max_iter, args.repeat,
+                             not args.no_memory, args.backends)
+    with open(args.output, 'w') as handle:
+        json.dump(results, handle, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as handle:
+            regressions = compare(results, json.load(handle), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,126 @@
+from BLEU_score import *
+import numpy as np
+
+
+def sentence_statistics(candidates, references, n):
+    """
+    Per-sentence BLEU sufficient statistics, ready for resampling.
+
+    INPUTS:
+    candidates :    (list) candidate sentences
+    references :    (list) for every candidate, the list of its reference sentences
+    n :             (int) the highest n-gram order
+
+    OUTPUT:
+    stats :         (array) one row per sentence: the matched k-gram counts for
+                    k = 1..n, the total k-gram counts, the candidate length and the
+                    closest reference length (see BLEU_score.bleu_stats)
+    """
+    stats = np.zeros((len(candidates), 2 * n + 2), dtype=np.int64)
+    for i, (candidate, sentence_references) in enumerate(zip(candidates, references)):
+        sentence_stats = bleu_stats(candidate, sentence_references, n)
+        stats[i, :n] = sentence_stats['matches']
+        stats[i, n:2 * n] = sentence_stats['totals']
+        stats[i, 2 * n] = sentence_stats['length']
+        stats[i, 2 * n + 1] = sentence_stats['ref_length']
+    return stats
+
+
+def corpus_bleu_rows(sums, n):
+    """
+    Vectorized BLEU_score.bleu_from_stats: the corpus BLEU score of every row of
+    summed sentence_statistics.
+    """
+    sums = np.atleast_2d(sums).astype(np.float64)
+    bleu_scores = np.ones(len(sums))
+    for k in range(n):
+        totals = sums[:, n + k]
+        bleu_scores *= np.divide(sums[:, k], totals, out=np.zeros(len(sums)), where=totals > 0)
+    bleu_scores **= 1 / n
+
+    brevity = sums[:, 2 * n + 1] / sums[:, 2 * n]
+    bleu_scores *= np.where(brevity >= 1, np.exp(1 - brevity), 1)
+    return bleu_scores
+
+
+def bootstrap_indices(num_sentences, samples=1000, seed=0):
+    """
+    A (samples, num_sentences) matrix of sentence indices drawn with replacement.
+    The same matrix is used for every system of a paired comparison.
+    """
+    return np.random.default_rng(seed).integers(0, num_sentences, size=(samples, num_sentences))
+
+
+def resample_sums(stats, indices):
+    """
+    The summed statistics of every resample. The index matrix is turned into
+    per-resample sentence counts with one bincount, so this is a single
+    (samples x sentences) by (sentences x statistics) product.
+    """
+    samples, num_sentences = indices.shape
+    rows = indices + num_sentences * np.arange(samples)[:, None]
+    weights = np.bincount(rows.ravel(), minlength=samples * num_sentences).reshape(samples, num_sentences)
+    return weights @ stats
+
+
+def bootstrap_bleu(stats, n, samples=1000, alpha=0.05, seed=0, indices=None):
+    """
+    Percentile bootstrap confidence interval of corpus BLEU.
+
+    INPUTS:
+    stats :     (array) sentence_statistics of a system
+    n :         (int) the highest n-gram order
+    samples :   (int) the number of resamples
+    alpha :     (float) the interval covers 1 - alpha
+    seed :      (int) seed of the resampling
+    indices :   (array) a bootstrap_indices matrix to use instead of drawing one
+
+    OUTPUT:
+    result :    (dictionary) 'bleu', the score on the whole test set, and 'low' and
+                'high', the bounds of the interval
+    """
+    if indices is None:
+        indices = bootstrap_indices(len(stats), samples, seed)
+
+    return _interval(stats, corpus_bleu_rows(resample_sums(stats, indices), n), n, alpha)
+
+
+def paired_bootstrap(stats_a, stats_b, n, samples=1000, alpha=0.05, seed=0):
+    """
+    Paired bootstrap resampling test of the BLEU difference between two systems
+    translating the same test sentences.
+
+    INPUTS:
+    stats_a :   (array) sentence_statistics of the first system
+    stats_b :   (array) sentence_statistics of the second system, same sentences
+    n :         (int) the highest n-gram order
+    samples :   (int) the number of resamples, shared by both systems
+    alpha :     (float) the confidence intervals cover 1 - alpha
+    seed :      (int) seed of the resampling
+
+    OUTPUT:
+    result :    (dictionary) 'a' and 'b', the bootstrap_bleu of each system,
+                'delta', the BLEU of a minus that of b, 'low' and 'high', the
+                interval of the difference, and 'p_value', the two-sided
+                probability of a difference of the other sign (or none)
+    """
+    if len(stats_a) != len(stats_b):
+        raise ValueError('the systems must be scored on the same sentences')
+
+    indices = bootstrap_indices(len(stats_a), samples, seed)
+    scores_a = corpus_bleu_rows(resample_sums(stats_a, indices), n)
+    scores_b = corpus_bleu_rows(resample_sums(stats_b, indices), n)
+    deltas = scores_a - scores_b
+    low, high = np.quantile(deltas, [alpha / 2, 1 - alpha / 2])
+    p_value = min(1.0, 2 * min(np.mean(deltas <= 0), np.mean(deltas >= 0)))
+
+    a = _interval(stats_a, scores_a, n, alpha)
+    b = _interval(stats_b, scores_b, n, alpha)
+    return {'a': a, 'b': b, 'delta': a['bleu'] - b['bleu'], 'low': float(low), 'high': float(high),
+            'p_value': float(p_value)}
+
+
+def _interval(stats, scores, n, alpha):
+    low, high = np.quantile(scores, [alpha / 2, 1 - alpha / 2])
+
+    return {'bleu': float(corpus_bleu_rows(stats.sum(axis=0), n)[0]), 'low': float(low), 'high': float(high)}
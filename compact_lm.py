@@ -0,0 +1,211 @@
+from collections.abc import Mapping
+import numpy as np
+
+
+def compact_lm(LM):
+    """
+    Convert a language model from lm_train into a CompactLM.
+
+    INPUTS:
+    LM :    (dictionary) the language model trained by lm_train
+
+    OUTPUT:
+    CLM :   (CompactLM) the same counts, stored as arrays. CLM['uni'] and CLM['bi']
+            answer the same queries as LM['uni'] and LM['bi'], so CLM can be passed
+            to log_prob, preplexity and decode.calc_score unchanged.
+    """
+    words = list(LM['uni'])
+    ids = {word: i for i, word in enumerate(words)}
+    for successors in LM['bi'].values():
+        for word in successors:
+            if word not in ids:
+                ids[word] = len(words)
+                words.append(word)
+
+    uni_counts = np.zeros(len(words), dtype=np.int64)
+    for word, count in LM['uni'].items():
+        uni_counts[ids[word]] = count
+
+    bi_offsets = np.zeros(len(words) + 1, dtype=np.int64)
+    for previous_word, successors in LM['bi'].items():
+        bi_offsets[ids[previous_word] + 1] = len(successors)
+    np.cumsum(bi_offsets, out=bi_offsets)
+
+    max_count = max((max(successors.values()) for successors in LM['bi'].values() if successors), default=0)
+    bi_successors = np.zeros(bi_offsets[-1], dtype=np.int32)
+    bi_counts = np.zeros(bi_offsets[-1], dtype=np.int32 if max_count < 2 ** 31 else np.int64)
+    for previous_word, successors in LM['bi'].items():
+        lo = bi_offsets[ids[previous_word]]
+        hi = lo + len(successors)
+        successor_ids = np.fromiter((ids[word] for word in successors), dtype=np.int32, count=len(successors))
+        counts = np.fromiter(successors.values(), dtype=bi_counts.dtype, count=len(successors))
+        order = np.argsort(successor_ids)
+        bi_successors[lo:hi] = successor_ids[order]
+        bi_counts[lo:hi] = counts[order]
+
+    return CompactLM(words, uni_counts, bi_offsets, bi_successors, bi_counts, num_unigrams=len(LM['uni']))
+
+
+def save_compact_lm(CLM, fn_LM):
+    """
+    Save a CompactLM to fn_LM + '.npz'.
+    """
+    np.savez(fn_LM + '.npz',
+             vocab=np.frombuffer('\n'.join(CLM.words).encode('utf-8'), dtype=np.uint8),
+             num_unigrams=np.array(CLM.num_unigrams),
+             uni_counts=CLM.uni_counts,
+             bi_offsets=CLM.bi_offsets,
+             bi_successors=CLM.bi_successors,
+             bi_counts=CLM.bi_counts)
+
+
+def load_compact_lm(fn_LM):
+    """
+    Load a CompactLM saved by save_compact_lm.
+    """
+    with np.load(fn_LM + '.npz') as data:
+        vocab = data['vocab'].tobytes().decode('utf-8')
+
+        return CompactLM(vocab.split('\n') if vocab else [], data['uni_counts'], data['bi_offsets'],
+                         data['bi_successors'], data['bi_counts'], num_unigrams=int(data['num_unigrams']))
+
+
+class CompactLM(Mapping):
+    """
+    A bigram language model stored in CSR form: word i has unigram count
+    uni_counts[i], and its successors are bi_successors[bi_offsets[i]:bi_offsets[i + 1]]
+    (sorted ids) with counts bi_counts[bi_offsets[i]:bi_offsets[i + 1]].
+
+    Indexing with 'uni' or 'bi' gives read-only views that behave like the
+    dictionaries of an lm_train language model.
+
+    ids maps words to their index in words; it is built from words unless given
+    (e.g. by model_bundle, which looks words up in place).
+    """
+
+    def __init__(self, words, uni_counts, bi_offsets, bi_successors, bi_counts, num_unigrams=None, ids=None):
+        self.words = words
+        self.ids = {word: i for i, word in enumerate(words)} if ids is None else ids
+        self.uni_counts = uni_counts
+        self.bi_offsets = bi_offsets
+        self.bi_successors = bi_successors
+        self.bi_counts = bi_counts
+        self.num_unigrams = len(words) if num_unigrams is None else num_unigrams
+        self._bigram_keys = None
+        self._views = {'uni': _Unigrams(self), 'bi': _Bigrams(self)}
+
+    def __getitem__(self, key):
+        return self._views[key]
+
+    def __iter__(self):
+        return iter(self._views)
+
+    def __len__(self):
+        return len(self._views)
+
+    def bigram_count(self, previous_id, word_id):
+        """
+        The count of the bigram (previous_id, word_id), 0 if it was never seen.
+        """
+        lo = self.bi_offsets[previous_id]
+        hi = self.bi_offsets[previous_id + 1]
+        k = lo + np.searchsorted(self.bi_successors[lo:hi], word_id)
+        if k < hi and self.bi_successors[k] == word_id:
+            return int(self.bi_counts[k])
+        return 0
+
+    def bigram_counts(self, previous_ids, word_ids):
+        """
+        Vectorized bigram_count over arrays of ids. Ids outside the vocabulary
+        (e.g. len(words) for unknown words) get a count of 0.
+        """
+        vocab_size = len(self.words)
+        keys = self.bigram_keys()
+        known = (previous_ids >= 0) & (previous_ids < vocab_size) & (word_ids >= 0) & (word_ids < vocab_size)
+        query = np.where(known, previous_ids.astype(np.int64) * vocab_size + word_ids, -1)
+
+        if len(keys) == 0:
+            return np.zeros(len(query), dtype=np.int64)
+
+        k = np.minimum(np.searchsorted(keys, query), len(keys) - 1)
+        return np.where(known & (keys[k] == query), self.bi_counts[k], 0)
+
+    def bigram_keys(self):
+        """
+        previous_id * len(words) + word_id for every stored bigram. The CSR layout
+        keeps these globally sorted, so they can be searched in one go.
+        """
+        if self._bigram_keys is None:
+            previous_ids = np.repeat(np.arange(len(self.words), dtype=np.int64), np.diff(self.bi_offsets))
+            self._bigram_keys = previous_ids * len(self.words) + self.bi_successors
+        return self._bigram_keys
+
+
+class _Unigrams(Mapping):
+
+    def __init__(self, CLM):
+        self.CLM = CLM
+
+    def __getitem__(self, word):
+        i = self.CLM.ids[word]
+        if i >= self.CLM.num_unigrams:
+            raise KeyError(word)
+        return int(self.CLM.uni_counts[i])
+
+    def __contains__(self, word):
+        return self.CLM.ids.get(word, self.CLM.num_unigrams) < self.CLM.num_unigrams
+
+    def __iter__(self):
+        return iter(self.CLM.words[:self.CLM.num_unigrams])
+
+    def __len__(self):
+        return self.CLM.num_unigrams
+
+
+class _Bigrams(Mapping):
+
+    def __init__(self, CLM):
+        self.CLM = CLM
+
+    def __getitem__(self, previous_word):
+        i = self.CLM.ids[previous_word]
+        if self.CLM.bi_offsets[i] == self.CLM.bi_offsets[i + 1]:
+            raise KeyError(previous_word)
+        return _Successors(self.CLM, i)
+
+    def __contains__(self, previous_word):
+        i = self.CLM.ids.get(previous_word)
+        return i is not None and self.CLM.bi_offsets[i] != self.CLM.bi_offsets[i + 1]
+
+    def __iter__(self):
+        offsets = self.CLM.bi_offsets
+        return (self.CLM.words[i] for i in np.flatnonzero(offsets[1:] != offsets[:-1]))
+
+    def __len__(self):
+        return int(np.count_nonzero(self.CLM.bi_offsets[1:] != self.CLM.bi_offsets[:-1]))
+
+
+class _Successors(Mapping):
+
+    def __init__(self, CLM, previous_id):
+        self.CLM = CLM
+        self.previous_id = previous_id
+
+    def __getitem__(self, word):
+        word_id = self.CLM.ids.get(word)
+        count = 0 if word_id is None else self.CLM.bigram_count(self.previous_id, word_id)
+        if count == 0:
+            raise KeyError(word)
+        return count
+
+    def __contains__(self, word):
+        word_id = self.CLM.ids.get(word)
+        return word_id is not None and self.CLM.bigram_count(self.previous_id, word_id) > 0
+
+    def __iter__(self):
+        lo = self.CLM.bi_offsets[self.previous_id]
+        hi = self.CLM.bi_offsets[self.previous_id + 1]
+        return (self.CLM.words[i] for i in self.CLM.bi_successors[lo:hi].tolist())
+
+    def __len__(self):
+        return int(self.CLM.bi_offsets[self.previous_id + 1] - self.CLM.bi_offsets[self.previous_id])
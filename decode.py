@@ -5,47 +5,105 @@ from preprocess import *
 from lm_train import *
 from log_prob import *
 from align_ibm1 import * 
+from multiprocessing import Pool
+from instrumentation import *
+import time
 
-def decode(french, LM, AM):
+@instrumented('decode')
+def decode(french, LM, AM, index=None, mode='random', beam_width=8, window=3, seed=None,
+           deadline=None, budget=None, stats=None, restarts=1, workers=1):
+    """
+    Translate a PROCESSED French sentence into English.
+
+    mode selects the search: 'random' keeps the best of MAXTRANS random candidate
+    choices and re-orderings, 'beam' runs beam_decode with the given beam_width
+    and reordering window, 'local' runs local_decode.
+    seed makes the random searches reproducible; by default they use the global
+    random module.
+
+    The search is anytime: it stops once `deadline` seconds have passed or `budget`
+    candidate translations have been scored (MAXTRANS + 1 for 'random', 2 * MAXTRANS
+    moves for 'local' and unlimited for 'beam' by default) and returns the best
+    translation found so far. If a dictionary is passed as stats, it receives
+    'evaluated' (the number of candidates scored), 'elapsed' (seconds) and
+    'expired' (whether the deadline cut the search short).
+
+    With restarts > 1, the 'random' and 'local' searches are split into that many
+    independent restarts sharing the budget, each seeded from seed (see
+    restart_seed), and the best result is kept. The restarts run in `workers`
+    processes of a pool kept between calls (see get_restart_pool); the translation
+    only depends on seed and restarts, not on workers. The deadline covers the whole
+    call, all restarts together.
+    """
     
     N = 5           # the maximum number of translations for each word in the sentence
     MAXTRANS = 128; # the maximum number of greedy transformations we perform 
     NUMSWAPS = 2;   # the number of random re-orderings of the words
     
-    proposed_french_words = french.split()
-    proposed_english_words = []
+    rng = random if seed is None else random.Random(seed)
+    start = time.perf_counter()
+    stop = None if deadline is None else start + deadline
+    if stats is None:
+        stats = dict()
+    stats.update(evaluated=0, expired=False)
     
-    english_words = AM.keys()
+    if mode == 'beam':
+        translation = beam_decode(french, LM, AM, index, beam_width, window, N, stop, stats, budget)
+    elif mode in ('random', 'local'):
+        if mode == 'local':
+            total = 2 * MAXTRANS if budget is None else budget
+        else:
+            total = MAXTRANS if budget is None else budget - 1
+        if restarts > 1:
+            if seed is None:
+                seed = random.getrandbits(32)
+            words = _restart_search(mode, french, LM, AM, index, total, N, seed, restarts, workers,
+                                    stop, stats)
+        else:
+            words = _SEARCHES[mode](french, LM, AM, index, total, N, rng, stop, stats)
+        translation = " ".join([x[0] for x in words])
+    else:
+        raise ValueError("Unknown decoding mode '{}'".format(mode))
     
-    for f_word in proposed_french_words:
-        alternatives = []
-        for e_word in english_words:
-            if f_word in AM[e_word]:
-                alternatives = deal_with_alternatives(alternatives, e_word, AM[e_word][f_word], 5)
-        if alternatives == []:
-            alternatives = [("UNK",0.01)]
-        proposed_english_words.append(alternatives)
+    stats['elapsed'] = time.perf_counter() - start
+    increment('decode.evaluated', stats['evaluated'])
+    return translation
+
+
+def _random_search(french, LM, AM, index, MAXTRANS, N, rng, stop, stats):
+    """
+    The random search of decode: keep the best of MAXTRANS random candidate choices
+    and re-orderings, stopping early once time.perf_counter() passes stop.
+    Returns the best sentence as (word, prob) pairs.
+    """
+    proposed_french_words = french.split()
+    proposed_english_words = get_candidates(proposed_french_words, AM, index, N)
 
     #print(proposed_english_words)
     # Randomly Iterate to find better sentences
     prediction = [word[0] for word in proposed_english_words]
     prediction_score = calc_score(prediction, LM)
+    stats['evaluated'] += 1
     #print("First Prediction:", " ".join([x[0] for x in prediction]), "\t Score:", prediction_score)
     
     for i in range(MAXTRANS):
+        if stop is not None and time.perf_counter() > stop:
+            stats['expired'] = True
+            break
         #pick new words
         new_guess = []
         for index in range(len(proposed_french_words)):
-            new_guess.append(random.choice(proposed_english_words[index]))
+            new_guess.append(rng.choice(proposed_english_words[index]))
         #re_order words
         #Take out start and end
         SS = [new_guess[0]]
         SE = [new_guess[-1]]
         new_guess = new_guess[1:-1]
-        random.shuffle(new_guess)
+        rng.shuffle(new_guess)
         new_guess = SS + new_guess + SE
 
         new_guess_prob = calc_score(new_guess, LM)
+        stats['evaluated'] += 1
         
         if new_guess_prob > prediction_score:
             prediction = new_guess
@@ -53,9 +111,404 @@ def decode(french, LM, AM):
             
     #print()
     #print("Last Prediction:", " ".join([x[0] for x in prediction]), "\t Score:", prediction_score)
-    return " ".join([x[0] for x in prediction])
+    return prediction
+
+
+def _restart_search(mode, french, LM, AM, index, total, N, seed, restarts, workers, stop, stats):
+    """
+    Split a budget of `total` evaluations over independent restarts of the 'random'
+    or 'local' search and return the best sentence. Ties go to the earliest restart,
+    so the result is the same however many workers run the restarts. Every restart
+    stops at the same time.perf_counter() value stop; perf_counter is the system-wide
+    monotonic clock, so it is the same instant in the worker processes.
+    """
+    if index is None:
+        index = get_candidate_index(AM, N)
+    if mode == 'random':
+        # every restart also scores its initial prediction, one is already counted in total
+        total = max(total + 1 - restarts, 0)
+    tasks = [(mode, french, total // restarts + (r < total % restarts), N, restart_seed(seed, r), stop)
+             for r in range(restarts)]
+
+    if workers <= 1:
+        results = [_run_restart(LM, AM, index, task) for task in tasks]
+    else:
+        results = get_restart_pool(LM, AM, index, min(workers, restarts)).map(_restart_task, tasks)
+
+    for words, restart_stats in results:
+        stats['evaluated'] += restart_stats['evaluated']
+        stats['expired'] = stats['expired'] or restart_stats['expired']
+
+    return max([words for words, restart_stats in results], key=lambda words: hypothesis_key(words, LM))
+
+
+def restart_seed(seed, r):
+    """
+    The seed of restart r of a decode call with the given seed.
+    """
+    return '{}/{}'.format(seed, r)
+
+
+def hypothesis_key(e_sentence, LM):
+    """
+    Sort key for (word, prob) sentences: fewer unseen bigrams first, then the sum
+    of the calc_score terms. Agrees with calc_score whenever that is finite.
+    """
+    terms = [bigram_score(e_sentence[i-1][0], e_sentence[i], LM) for i in range(1, len(e_sentence))]
+    finite = [t for t in terms if t != float("-inf")]
+    score = 0
+    for t in finite:
+        score += t
+    return (len(finite) - len(terms), score)
+
+
+_restart_pool = None
+
+
+def get_restart_pool(LM, AM, index, workers):
+    """
+    The process pool decode runs restarts in. It is started on first use and kept
+    while decode is called with the same LM, AM, index and number of workers, so a
+    decode call does not pay for starting processes.
+    """
+    global _restart_pool
+    if _restart_pool is None or _restart_pool[0] is not LM or _restart_pool[1] is not AM or \
+            _restart_pool[2] is not index or _restart_pool[3] != workers:
+        if _restart_pool is not None:
+            _restart_pool[4].terminate()
+        pool = Pool(workers, initializer=init_decode_worker, initargs=(LM, AM, index, None, dict()))
+        _restart_pool = (LM, AM, index, workers, pool)
+    return _restart_pool[4]
+
+
+def _run_restart(LM, AM, index, task):
+    mode, french, total, N, seed, stop = task
+    restart_stats = dict(evaluated=0, expired=False)
+    words = _SEARCHES[mode](french, LM, AM, index, total, N, random.Random(seed), stop, restart_stats)
+    return words, restart_stats
+
+
+def _restart_task(task):
+    return _run_restart(_decode_worker['LM'], _decode_worker['AM'], _decode_worker['index'], task)
     
     
+def decode_many(sentences, LM, AM, workers=1, seed=0, **options):
+    """
+    Decode a list of PROCESSED French sentences, spread over a process pool.
+
+    The workers get LM, AM and the candidate index once, when the pool starts
+    (inherited through fork where available), not with every sentence. Sentence i
+    is decoded with its own seed derived from (seed, i), so the output, returned in
+    input order, is the same for any number of workers. options are passed on to
+    decode (mode, beam_width, window).
+    """
+    index = get_candidate_index(AM)
+    tasks = [(i, french) for i, french in enumerate(sentences)]
+
+    if workers <= 1:
+        init_decode_worker(LM, AM, index, seed, options)
+        return [_decode_task(task) for task in tasks]
+
+    with Pool(workers, initializer=init_decode_worker, initargs=(LM, AM, index, seed, options)) as pool:
+        return pool.map(_decode_task, tasks, chunksize=max(1, len(tasks) // (4 * workers)))
+
+
+def sentence_seed(seed, i):
+    """
+    The seed decode_many uses for sentence i.
+    """
+    return '{}-{}'.format(seed, i)
+
+
+_decode_worker = dict()
+
+
+def init_decode_worker(LM, AM, index=None, seed=0, options=None):
+    """
+    Give this process the models, candidate index, base seed and decode options that
+    decode_in_worker and decode_many's tasks use. Pass it as the initializer of a
+    pool of decoding processes, so the models reach every worker once.
+    """
+    if index is None:
+        index = get_candidate_index(AM)
+    _decode_worker.update(LM=LM, AM=AM, index=index, seed=seed, options=dict(options or {}))
+
+
+def decode_in_worker(french, seed):
+    """
+    Decode a PROCESSED French sentence with the models and options set by
+    init_decode_worker, using the given seed.
+    """
+    return decode(french, _decode_worker['LM'], _decode_worker['AM'], _decode_worker['index'], seed=seed,
+                  **_decode_worker['options'])
+
+
+def _decode_task(task):
+    i, french = task
+    return decode_in_worker(french, sentence_seed(_decode_worker['seed'], i))
+
+
+def beam_decode(french, LM, AM, index=None, beam_width=8, window=3, N=5, stop=None, stats=None, budget=None):
+    """
+    Deterministic alternative to the random search in decode.
+
+    The English sentence is built left to right. Each step translates one of the
+    first `window` French words not yet covered, with one of its N candidates, and
+    adds that word's calc_score term. Hypotheses covering the same French words and
+    ending in the same English word are recombined. Only the best beam_width are
+    kept after each step. As in decode, the first and last words (SENTSTART and
+    SENTEND) stay in place, each translated with its top candidate: calc_score
+    never scores the first word's probability, so the LM alone would pick it.
+
+    Hypotheses are ranked as hypothesis_key ranks sentences: fewer unseen bigrams
+    first, then the larger sum of the finite terms, so the beam still keeps the best
+    hypotheses once every expansion has hit an unseen bigram and calc_score is -inf.
+
+    The work per sentence is bounded by len(french) * beam_width * window * N
+    score updates. Once budget score updates have been made, no more expansions are
+    scored. Then, or if time.perf_counter() has passed stop between two steps, the
+    best hypothesis so far is completed with the top candidates of the remaining
+    words, in French order, which takes one more score update per remaining word.
+    stats, if given, counts the score updates in stats['evaluated'].
+    """
+    french_words = french.split()
+    if french_words == []:
+        return ""
+    if stats is None:
+        stats = dict(evaluated=0, expired=False)
+
+    candidates = get_candidates(french_words, AM, index, N)
+    last = len(french_words) - 1
+
+    # A hypothesis is (score, english words as (word, prob) pairs, covered positions bitmask),
+    # where score is (-number of unseen bigrams, sum of the finite terms)
+    beam = [((0, 0), (candidates[0][0],), 0)]
+    for step in range(1, last):
+        expired = stop is not None and time.perf_counter() > stop
+        if expired or (budget is not None and stats['evaluated'] >= budget):
+            stats['expired'] = expired
+            score, words, covered = max(beam, key=lambda hypothesis: hypothesis[0])
+            for position in range(1, last):
+                if not covered >> position & 1:
+                    score = _add_term(score, bigram_score(words[-1][0], candidates[position][0], LM))
+                    words += (candidates[position][0],)
+                    covered |= 1 << position
+                    stats['evaluated'] += 1
+            beam = [(score, words, covered)]
+            break
+        expansions = dict()
+        for score, words, covered in beam:
+            first = 1
+            while covered >> first & 1:
+                first += 1
+            for position in range(first, min(first + window, last)):
+                if covered >> position & 1:
+                    continue
+                for candidate in candidates[position]:
+                    if budget is not None and stats['evaluated'] >= budget:
+                        break
+                    new_score = _add_term(score, bigram_score(words[-1][0], candidate, LM))
+                    stats['evaluated'] += 1
+                    key = (covered | 1 << position, candidate[0])
+                    if key not in expansions or new_score > expansions[key][0]:
+                        expansions[key] = (new_score, words + (candidate,), key[0])
+        # a step the budget cut short keeps the expansions it made
+        if expansions:
+            beam = sorted(expansions.values(), key=lambda hypothesis: hypothesis[0], reverse=True)[:beam_width]
+
+    if last > 0:
+        beam = [(_add_term(score, bigram_score(words[-1][0], candidates[last][0], LM)),
+                 words + (candidates[last][0],), covered) for score, words, covered in beam]
+        stats['evaluated'] += len(beam)
+
+    best = max(beam, key=lambda hypothesis: hypothesis[0])
+    return " ".join([x[0] for x in best[1]])
+
+
+def _add_term(score, term):
+    """
+    Add a calc_score term to a beam_decode score (-unseen bigrams, finite sum).
+    """
+    if term == float("-inf"):
+        return (score[0] - 1, score[1])
+    return (score[0], score[1] + term)
+
+
+def local_decode(french, LM, AM, index=None, moves=256, N=5, rng=random, stop=None, stats=None):
+    """
+    Hill-climbing alternative to the random search in decode.
+
+    Starts from the most probable candidate of every French word, in French order,
+    and tries `moves` random local moves: swapping two words or replacing one word
+    with another of its candidates. SENTSTART and SENTEND stay in place, with their
+    top candidate. A move
+    only changes up to four bigrams, so it is scored by re-evaluating just those,
+    with the LM part of each bigram memoized per LM (see get_bigram_cache). Moves
+    that do not make the sentence worse are kept. rng supplies the randomness.
+    The search stops early once time.perf_counter() passes stop; stats, if given,
+    counts the moves scored in stats['evaluated'].
+
+    A sentence is better if it has fewer unseen bigrams, then if its calc_score
+    terms sum higher, so the search can make progress while calc_score is -inf.
+    """
+    return " ".join([x[0] for x in _local_search(french, LM, AM, index, moves, N, rng, stop, stats)])
+
+
+def _local_search(french, LM, AM, index, moves, N, rng, stop, stats):
+    """
+    The search of local_decode. Returns the final sentence as (word, prob) pairs.
+    """
+    french_words = french.split()
+    if french_words == []:
+        return []
+
+    if stats is None:
+        stats = dict(evaluated=0, expired=False)
+
+    candidates = get_candidates(french_words, AM, index, N)
+    candidate_logs = [[log(candidate[1], 2) for candidate in alternatives] for alternatives in candidates]
+    cache = get_bigram_cache(LM)
+    last = len(french_words) - 1
+
+    # Position k of the English sentence translates French word source[k] with its choice[k]-th candidate
+    source = list(range(len(french_words)))
+    choice = [0] * len(french_words)
+
+    def term(k):
+        lm_score = cached_lm_score(candidates[source[k - 1]][choice[k - 1]][0],
+                                   candidates[source[k]][choice[k]][0], LM, cache)
+        if lm_score == float("-inf"):
+            return lm_score
+        return candidate_logs[source[k]][choice[k]] + lm_score
+
+    # terms[k] is the calc_score term of the bigram ending at position k
+    terms = [0] + [term(k) for k in range(1, last + 1)]
+
+    for i in range(moves):
+        if stop is not None and time.perf_counter() > stop:
+            stats['expired'] = True
+            break
+        stats['evaluated'] += 1
+        if last >= 3 and rng.random() < 0.5:
+            j, k = rng.sample(range(1, last), 2)
+            bigrams = sorted({j, j + 1, k, k + 1})
+            source[j], source[k] = source[k], source[j]
+            choice[j], choice[k] = choice[k], choice[j]
+            new_terms = [term(b) for b in bigrams]
+            if _better_or_equal(new_terms, [terms[b] for b in bigrams]):
+                for b, new_term in zip(bigrams, new_terms):
+                    terms[b] = new_term
+            else:
+                source[j], source[k] = source[k], source[j]
+                choice[j], choice[k] = choice[k], choice[j]
+        else:
+            # SENTSTART and SENTEND keep their top candidate, as in decode
+            if last < 2:
+                continue
+            j = rng.randrange(1, last)
+            if len(candidates[source[j]]) < 2:
+                continue
+            bigrams = [j, j + 1]
+            previous_choice = choice[j]
+            choice[j] = rng.randrange(len(candidates[source[j]]) - 1)
+            if choice[j] >= previous_choice:
+                choice[j] += 1
+            new_terms = [term(b) for b in bigrams]
+            if _better_or_equal(new_terms, [terms[b] for b in bigrams]):
+                for b, new_term in zip(bigrams, new_terms):
+                    terms[b] = new_term
+            else:
+                choice[j] = previous_choice
+
+    return [candidates[source[k]][choice[k]] for k in range(len(french_words))]
+
+
+def _better_or_equal(new_terms, old_terms):
+    """
+    Compare two sets of calc_score terms: fewer -inf terms wins, then the larger sum.
+    """
+    new_finite = [t for t in new_terms if t != float("-inf")]
+    old_finite = [t for t in old_terms if t != float("-inf")]
+    if len(new_finite) != len(old_finite):
+        return len(new_finite) > len(old_finite)
+    return sum(new_finite) >= sum(old_finite)
+
+
+_SEARCHES = {'random': _random_search, 'local': _local_search}
+
+
+def get_candidates(french_words, AM, index=None, N=5):
+    """
+    The list of (english_word, probability) candidates of every French word, with
+    [("UNK", 0.01)] for words AM has never seen.
+    """
+    if index is None:
+        index = get_candidate_index(AM, N)
+
+    proposed_english_words = []
+    for f_word in french_words:
+        alternatives = index.get(f_word, [])
+        if alternatives == []:
+            alternatives = [("UNK",0.01)]
+        proposed_english_words.append(alternatives)
+    return proposed_english_words
+
+
+def build_candidate_index(AM, N = 5):
+    """
+    Invert AM into a dictionary from each French word to its N most probable English
+    translations, as a list of (english_word, probability) sorted by decreasing
+    probability. Ties keep the order of AM, so the candidates are the ones the
+    original scan over AM.keys() with deal_with_alternatives picked.
+    """
+    index = dict()
+    for e_word in AM:
+        for f_word, prob in AM[e_word].items():
+            candidates = index.get(f_word)
+            if candidates is None:
+                index[f_word] = [(e_word, prob)]
+            elif len(candidates) < N or prob > candidates[-1][1]:
+                position = len(candidates)
+                while position > 0 and candidates[position - 1][1] < prob:
+                    position -= 1
+                candidates.insert(position, (e_word, prob))
+                if len(candidates) > N:
+                    candidates.pop()
+    return index
+
+
+_candidate_index = None
+
+
+def get_candidate_index(AM, N = 5):
+    """
+    The candidate index of AM, built on first use and reused while decode is
+    called with the same AM. An AM loaded from a model bundle brings its own.
+    """
+    global _candidate_index
+    if getattr(AM, 'candidate_N', None) == N:
+        return AM.candidate_index
+    if _candidate_index is None or _candidate_index[0] is not AM or _candidate_index[1] != N:
+        _candidate_index = (AM, N, build_candidate_index(AM, N))
+    return _candidate_index[2]
+
+
+def save_candidate_index(index, fn_AM):
+    """
+    Save a candidate index next to the AM pickle, as fn_AM + '.index.pickle'.
+    """
+    with open(fn_AM + '.index.pickle', 'wb') as handle:
+        pickle.dump(index, handle, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_candidate_index(fn_AM):
+    """
+    Load the candidate index saved next to the AM pickle fn_AM + '.pickle'.
+    """
+    with open(fn_AM + '.index.pickle', 'rb') as handle:
+        return pickle.load(handle)
+
+
 def deal_with_alternatives(lst, word, prob, num_words = 5):
     if len(lst) < num_words:
         lst.append((word, prob))
@@ -69,10 +522,53 @@ def deal_with_alternatives(lst, word, prob, num_words = 5):
 def calc_score(e_sentence, LM):
     score = 0
     for i in range(1, len(e_sentence)):
-        word_i = e_sentence[i][0]
-        word_i_1 = e_sentence[i-1][0]
-        if word_i in LM['uni'] and word_i in LM['bi'][word_i_1]:
-            score += log(e_sentence[i][1], 2) + log(LM['bi'][word_i_1][word_i], 2) + log(LM['uni'][word_i], 2)
-        else:
-            return float("-inf")
+        score += bigram_score(e_sentence[i-1][0], e_sentence[i], LM)
+        if score == float("-inf"):
+            return score
     return score
+
+
+# The most bigrams get_bigram_cache keeps between two sentences
+BIGRAM_CACHE_SIZE = 1 << 20
+_bigram_cache = None
+
+
+def get_bigram_cache(LM):
+    """
+    The memo of cached_lm_score for LM, kept while decoding with the same LM. It is
+    emptied when it holds more than BIGRAM_CACHE_SIZE bigrams, so a long-running
+    process (e.g. translate_server) does not grow it without bound.
+    """
+    global _bigram_cache
+    if _bigram_cache is None or _bigram_cache[0] is not LM:
+        _bigram_cache = (LM, dict())
+    elif len(_bigram_cache[1]) > BIGRAM_CACHE_SIZE:
+        _bigram_cache[1].clear()
+    return _bigram_cache[1]
+
+
+def cached_lm_score(previous_word, word, LM, cache):
+    """
+    The LM part of bigram_score, log(count(previous_word word), 2) + log(count(word), 2),
+    or -inf for an unseen bigram, memoized in cache.
+    """
+    key = (previous_word, word)
+    lm_score = cache.get(key)
+    if lm_score is None:
+        if word in LM['uni'] and previous_word in LM['bi'] and word in LM['bi'][previous_word]:
+            lm_score = log(LM['bi'][previous_word][word], 2) + log(LM['uni'][word], 2)
+        else:
+            lm_score = float("-inf")
+        cache[key] = lm_score
+    return lm_score
+
+
+def bigram_score(previous_word, candidate, LM):
+    """
+    The term calc_score adds for candidate (word, prob) following previous_word,
+    -inf if the bigram was never seen (or previous_word never starts one).
+    """
+    word = candidate[0]
+    if word in LM['uni'] and previous_word in LM['bi'] and word in LM['bi'][previous_word]:
+        return log(candidate[1], 2) + log(LM['bi'][previous_word][word], 2) + log(LM['uni'][word], 2)
+    return float("-inf")
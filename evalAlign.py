@@ -8,6 +8,10 @@ import decode
 # from decode import *
 from align_ibm1 import *
 from BLEU_score import *
+from bleu_bootstrap import *
+from experiment_grid import *
+from model_bundle import *
+from instrumentation import *
 from lm_train import *
 
 __author__ = 'Raeid Saqur'
@@ -69,19 +73,27 @@ def _getLM(data_dir, language, fn_LM, use_cached=True):
                     to train or decode. e.g., '/u/cs401/A2_SMT/data/Toy/'
     language    : (string) either 'e' (English) or 'f' (French)
     fn_LM       : (string) the location to save the language model once trained
-    use_cached  : (boolean) optionally load cached LM using pickle.
+    use_cached  : (boolean) optionally load the cached LM, memory mapping its
+                    bundle (see model_bundle). An LM cached only as a pickle is
+                    converted to a bundle on first use.
 
     Returns
     -------
     A language model
     """
 
+    if use_cached is True and os.path.exists(fn_LM + BUNDLE_SUFFIX):
+        return load_lm_bundle(fn_LM)
+
     if use_cached is True:
-        LM = pickle.load(open(fn_LM + '.pickle', "rb"))
+        with open(fn_LM + '.pickle', 'rb') as handle:
+            LM = pickle.load(handle)
     else:
         LM = lm_train(data_dir, language, fn_LM)
 
-    return LM
+    save_lm_bundle(LM, fn_LM, params={'data_dir': data_dir, 'language': language},
+                   corpus=corpus_hash(data_dir, language) if os.path.isdir(data_dir) else None)
+    return load_lm_bundle(fn_LM)
 
 def _getAM(data_dir, num_sent, max_iter, fn_AM, use_cached=True):
     """
@@ -91,38 +103,33 @@ def _getAM(data_dir, num_sent, max_iter, fn_AM, use_cached=True):
     num_sent    : (int) the maximum number of training sentences to consider
     max_iter    : (int) the maximum number of iterations of the EM algorithm
     fn_AM       : (string) the location to save the alignment model
-    use_cached  : (boolean) optionally load cached AM using pickle.
+    use_cached  : (boolean) optionally load the cached AM, memory mapping its
+                    bundle (see model_bundle). An AM cached only as a pickle is
+                    converted to a bundle on first use.
 
     Returns
     -------
     An alignment model
     """
+    if use_cached is True and os.path.exists(fn_AM + BUNDLE_SUFFIX):
+        return load_am_bundle(fn_AM)
+
     if use_cached is True:
-        AM = pickle.load(open(fn_AM + '.pickle', 'rb'))
+        with open(fn_AM + '.pickle', 'rb') as handle:
+            AM = pickle.load(handle)
     else:
         AM = align_ibm1(data_dir, num_sent, max_iter, fn_AM)
 
-    return AM
+    save_am_bundle(AM, fn_AM, params={'data_dir': data_dir, 'num_sentences': num_sent, 'max_iter': max_iter},
+                   corpus=corpus_hash(data_dir) if os.path.isdir(data_dir) else None)
+    return load_am_bundle(fn_AM)
 
 
 def calculate_brevity(candidate, references):
-    diff = None
     candidate_length = len(candidate.split(' '))
-    reference_length = None
-    for reference in references:
-        ref_length = len(reference.split(' '))
-        tmp_diff = math.fabs(candidate_length - ref_length)
-        if diff is None or tmp_diff < diff:
-            diff = tmp_diff
-            reference_length = ref_length
-    brevity_score = reference_length / candidate_length
-
-    if brevity_score >= 1:
-        brevity_score = math.exp(1 - brevity_score)
-    else:
-        brevity_score = 1
+    reference_length = closest_length(candidate_length, [len(reference.split(' ')) for reference in references])
 
-    return brevity_score
+    return brevity_penalty(candidate_length, reference_length)
 
 
 def _get_BLEU_scores(eng_decoded, eng, google_refs, n):
@@ -142,90 +149,58 @@ def _get_BLEU_scores(eng_decoded, eng, google_refs, n):
     bleu_scores = []
 
     for index in range(len(eng)):
-        r1 = eng[index]
-        r2 = google_refs[index]
-        c = eng_decoded[index]
-
-        r = [r1, r2]
-        bleu_score = 1
-        for i in range(n):
-            i = i + 1
-
-            bleu_score *= BLEU_score(c, r, i)
-        bleu_score = bleu_score ** (1 / n)
-        bleu_score *= calculate_brevity(c, r)
-        bleu_scores.append(bleu_score)
+        r = [eng[index], google_refs[index]]
+        bleu_scores.append(sentence_bleu(eng_decoded[index], r, n))
 
     return bleu_scores
 
 
 def main(args):
     """
-    #TODO: Perform outlined tasks in assignment, like loading alignment
-    models, computing BLEU scores etc.
-
-    (You may use the helper functions)
-
-    It's entirely upto you how you want to write Task5.txt. This is just
-    an (sparse) example.
+    Train an AM for every number of training sentences, decode the Task5 test set
+    with each and report the BLEU scores (see experiment_grid.run_grid), then test
+    whether each increase in training data made a significant difference.
     """
-    LM = _getLM('u/cs401/A2 SMT/data/Hansard/Training/', 'e', 'LM', use_cached=True)
+    if args.instrument or args.profile:
+        enable_instrumentation(profile=args.profile)
+
+    LM = _getLM(args.train_dir, 'e', 'LM', use_cached=True)
 
     sentence_lengths = [1000, 10000, 15000, 30000]
     bigram_sizes = [1, 2, 3]
-    BLEU_scores = []
-
-    task5_e_f = open('u/cs401/A2 SMT/data/Hansard/Testing/Task5.e', 'r')
-    task5_f_f = open('u/cs401/A2 SMT/data/Hansard/Testing/Task5.f', 'r')
-    task5_g_f = open('u/cs401/A2 SMT/data/Hansard/Testing/Task5.google.e', 'r')
-
-    french = task5_f_f.readlines()
-    french = [preprocess(french[i], 'f') for i in range(len(french))]
-
-    eng = task5_e_f.readlines()
-    eng = [preprocess(eng[i], 'f') for i in range(len(eng))]
-
-    eng_g = task5_g_f.readlines()
-    french = [preprocess(eng_g[i], 'f') for i in range(len(eng_g))]
-
-    for sentence_length in sentence_lengths:
-        AM = _getAM('u/cs401/A2 SMT/data/Hansard/Training/', sentence_length, 150, 'AM', use_cached=True)
-        eng_decoded = [decode.decode(french_word, LM, AM) for french_word in french]
-        for n in bigram_sizes:
-            score = _get_BLEU_scores(eng_decoded, eng, eng_g, n)
-            BLEU_scores.append(score)
-            print('sentences: {}, bigram count: {}, average: {} scores:'.format(sentence_length, n, np.mean(score)))
-            print(score)
-
-    # Write Results to Task5.txt (See e.g. Task5_eg.txt for ideation). ##
-
-    #
-    # f = open("Task5_.txt", 'w+')
-    # f.write(discussion)
-    # f.write("\n\n")
-    # f.write("-" * 10 + "Evaluation START" + "-" * 10 + "\n")
-    #
-    # for i, AM in enumerate(AMs):
-    #
-    #     f.write(f"\n### Evaluating AM model: {AM_names[i]} ### \n")
-    #     # Decode using AM #
-    #     # Eval using 3 N-gram models #
-    #     all_evals = []
-    #     for n in range(1, 4):
-    #         f.write(f"\nBLEU scores with N-gram (n) = {n}: ")
-    #         evals = _get_BLEU_scores(...)
-    #         for v in evals:
-    #             f.write(f"\t{v:1.4f}")
-    #         all_evals.append(evals)
-    #
-    #     f.write("\n\n")
-    #
-    # f.write("-" * 10 + "Evaluation END" + "-" * 10 + "\n")
-    # f.close()
 
+    results = run_grid(LM, args.train_dir, args.test_dir, args.out_dir, sentence_lengths, args.max_iter,
+                       bigram_sizes, workers=args.grid_workers, decode_workers=args.workers,
+                       discussion=discussion, mode=args.decoder, beam_width=args.beam_width,
+                       window=args.window, deadline=args.deadline, tol=args.tol)
+    results = [result for result in results if 'error' not in result]
+
+    # 25 test sentences are few: check whether more training data made a significant difference
+    for n in bigram_sizes:
+        for smaller, larger in zip(results, results[1:]):
+            result = paired_bootstrap(np.array(larger['bleu'][str(n)]['stats']),
+                                      np.array(smaller['bleu'][str(n)]['stats']), n, samples=10000)
+            print('bigram count: {}, {} vs {} sentences: BLEU difference {:.4f} (95% CI [{:.4f}, {:.4f}], p = {:.4f})'.format(
+                n, larger['num_sentences'], smaller['num_sentences'], result['delta'], result['low'], result['high'],
+                result['p_value']))
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Use parser for debugging if needed")
+    parser.add_argument('--decoder', choices=['random', 'beam', 'local'], default='random',
+                        help="search used by decode.decode")
+    parser.add_argument('--beam-width', type=int, default=8, help="hypotheses kept by the beam decoder")
+    parser.add_argument('--window', type=int, default=3, help="reordering window of the beam decoder")
+    parser.add_argument('--workers', type=int, default=1, help="processes to decode the test set with")
+    parser.add_argument('--deadline', type=float, default=None, help="seconds allowed per sentence")
+    parser.add_argument('--train-dir', default='u/cs401/A2 SMT/data/Hansard/Training/', help="training data")
+    parser.add_argument('--test-dir', default='u/cs401/A2 SMT/data/Hansard/Testing/', help="Task5 test data")
+    parser.add_argument('--out-dir', default='Task5', help="where to write AMs, results and the Task5 report")
+    parser.add_argument('--max-iter', type=int, default=150, help="EM iterations of every AM")
+    parser.add_argument('--tol', type=float, default=None, help="stop EM once no probability changes by more")
+    parser.add_argument('--instrument', action='store_true',
+                        help="time the pipeline stages and print a summary at exit (or set SMT_INSTRUMENT=1)")
+    parser.add_argument('--profile', default=None, help="also write cProfile statistics to this file")
+    parser.add_argument('--grid-workers', type=int, default=1, help="training sizes to run at the same time")
     args = parser.parse_args()
-    main('args')
+    main(args)
@@ -0,0 +1,300 @@
+from align_ibm1 import *
+from bleu_bootstrap import *
+from model_bundle import *
+import decode
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import traceback
+import hashlib
+import json
+import csv
+import os
+
+# Bump whenever a change alters the results of a grid point, so finished points are rerun.
+GRID_VERSION = 1
+
+
+def run_grid(LM, train_dir, test_dir, out_dir, sentence_lengths, max_iter, ngram_sizes, workers=1,
+             decode_workers=1, backend='python', am_dir=None, discussion='', tol=None, checkpoint_every=5,
+             **options):
+    """
+    Train an AM for every number of training sentences, decode the Task5 test set
+    with it and score the translations, running the grid points concurrently.
+
+    INPUTS:
+    LM :                (dictionary) the English language model
+    train_dir :         (string) the training data, as passed to align_ibm1
+    test_dir :          (string) the directory holding Task5.f, Task5.e and Task5.google.e
+    out_dir :           (string) where to write the results
+    sentence_lengths :  (list) the num_sentences of every grid point
+    max_iter :          (int) EM iterations for every AM
+    ngram_sizes :       (list) the n of the BLEU scores to compute
+    workers :           (int) the number of grid points to run at the same time
+    decode_workers :    (int) processes decode_many uses when the points run serially
+    backend :           (string) the align_ibm1 backend
+    am_dir :            (string) where trained AMs are cached, defaults to out_dir + '/AM'
+    discussion :        (string) text to start the Task5 report with
+    tol :               (float) stop EM early once it has converged to tol (see align_ibm1)
+    checkpoint_every :  (int) checkpoint every AM's training this often (see align_ibm1), so
+                        a point that crashed resumes its training instead of restarting it
+    options :           passed on to decode.decode (mode, beam_width, ...)
+
+    OUTPUT:
+    results :           (list) the result of every finished point, by num_sentences
+
+    Every AM is cached under a key derived from its training parameters (see
+    AM_key), and the result of every point is written to out_dir/points, under a key
+    that includes the contents of LM (see LM_key), as soon as it finishes. Rerunning
+    the grid skips finished points and reuses cached AMs, so a crashed point only
+    costs itself: the others still finish and are reported. That includes a worker
+    process that dies (e.g. killed for running out of memory): the points that were
+    running are retried one at a time, and the one that kills its process again is
+    reported as failed.
+    Once the grid is done, results.json, results.csv and Task5.txt are written to
+    out_dir.
+    """
+    if am_dir is None:
+        am_dir = os.path.join(out_dir, 'AM')
+    points_dir = os.path.join(out_dir, 'points')
+    os.makedirs(points_dir, exist_ok=True)
+    os.makedirs(am_dir, exist_ok=True)
+
+    test_set = read_test_set(test_dir)
+    config = {'train_dir': train_dir, 'max_iter': max_iter, 'ngram_sizes': list(ngram_sizes),
+              'backend': backend, 'am_dir': am_dir, 'options': options, 'tol': tol, 'LM': LM_key(LM),
+              'decode_workers': decode_workers if workers <= 1 else 1, 'checkpoint_every': checkpoint_every}
+
+    pending = []
+    for num_sentences in sentence_lengths:
+        if not os.path.exists(_point_file(points_dir, num_sentences, config, test_set)):
+            pending.append(num_sentences)
+        else:
+            print('sentences: {}, already done'.format(num_sentences))
+
+    # The largest points take longest, start them first.
+    pending.sort(reverse=True)
+    failed = {}
+    if workers > 1 and len(pending) > 1:
+        broken = _run_points(pending, min(workers, len(pending)), LM, test_set, config, points_dir, failed)
+        # a worker died and took the pool down: find the point that kills its process
+        for num_sentences in broken:
+            for lost in _run_points([num_sentences], 1, LM, test_set, config, points_dir, failed):
+                _save_point(points_dir, lost, config, test_set, {
+                    'num_sentences': lost, 'max_iter': max_iter,
+                    'error': 'BrokenProcessPool: the grid worker process died (e.g. killed for memory)'}, failed)
+    else:
+        _init_grid_worker(LM, test_set, config)
+        for num_sentences in pending:
+            _save_point(points_dir, num_sentences, config, test_set, _grid_task(num_sentences)[1], failed)
+
+    results = []
+    for num_sentences in sorted(sentence_lengths):
+        point_file = _point_file(points_dir, num_sentences, config, test_set)
+        if os.path.exists(point_file):
+            with open(point_file, 'r') as handle:
+                results.append(json.load(handle))
+        elif num_sentences in failed:
+            results.append(failed[num_sentences])
+
+    write_results(results, out_dir, ngram_sizes, discussion)
+    return results
+
+
+def AM_key(train_dir, num_sentences, max_iter, backend='python', tol=None):
+    """
+    The name an AM trained with these parameters is cached under.
+    """
+    params = [os.path.abspath(train_dir), num_sentences, max_iter, backend]
+    if tol is not None:
+        params.append(tol)
+    params = json.dumps(params)
+    return 'AM-{}-{}-{}'.format(num_sentences, max_iter, hashlib.sha1(params.encode('utf-8')).hexdigest()[:12])
+
+
+def LM_key(LM):
+    """
+    A hash of the contents of LM (a dictionary or CompactLM), so grid points decoded
+    with a retrained LM are not reused.
+    """
+    CLM = LM if isinstance(LM, CompactLM) else compact_lm(LM)
+    digest = hashlib.sha1(str(CLM.num_unigrams).encode('utf-8'))
+    if isinstance(CLM.words, MappedVocab):
+        digest.update(np.ascontiguousarray(CLM.words.blob).tobytes())
+        digest.update(np.ascontiguousarray(CLM.words.offsets).tobytes())
+    else:
+        digest.update('\n'.join(CLM.words).encode('utf-8'))
+    for array in (CLM.uni_counts, CLM.bi_offsets, CLM.bi_successors, CLM.bi_counts):
+        digest.update(np.ascontiguousarray(array).tobytes())
+    return digest.hexdigest()[:12]
+
+
+def get_cached_AM(train_dir, num_sentences, max_iter, am_dir, backend='python', tol=None, checkpoint_every=None):
+    """
+    Load the AM trained with these parameters from am_dir, training and caching it
+    first if needed. AMs are cached as memory-mapped model bundles (see model_bundle),
+    so grid workers share their pages. The bundle is written under a temporary name
+    and renamed, so an interrupted training never leaves a truncated AM behind. The
+    per-iteration EM metrics of the training are logged to the AM's name + '.log.jsonl'.
+    With checkpoint_every, an interrupted training resumes from its last checkpoint.
+    """
+    fn_AM = os.path.join(am_dir, AM_key(train_dir, num_sentences, max_iter, backend, tol))
+
+    if os.path.exists(fn_AM + BUNDLE_SUFFIX):
+        return load_am_bundle(fn_AM)
+
+    # a stable name, so the checkpoint of a crashed training is found again
+    tmp = fn_AM + '.partial'
+    if os.path.exists(fn_AM + '.log.jsonl') and not os.path.exists(tmp + '.checkpoint.pickle'):
+        os.remove(fn_AM + '.log.jsonl')
+    AM = align_ibm1(train_dir, num_sentences, max_iter, tmp, backend=backend, tol=tol, log_file=fn_AM + '.log.jsonl',
+                    checkpoint_every=checkpoint_every, resume=True)
+    params = {'train_dir': train_dir, 'num_sentences': num_sentences, 'max_iter': max_iter, 'backend': backend,
+              'tol': tol}
+    save_am_bundle(AM, tmp, params=params, corpus=corpus_hash(train_dir) if os.path.isdir(train_dir) else None)
+    os.replace(tmp + BUNDLE_SUFFIX, fn_AM + BUNDLE_SUFFIX)
+    os.remove(tmp + '.pickle')
+    return load_am_bundle(fn_AM)
+
+
+def read_test_set(test_dir):
+    """
+    The preprocessed French Task5 sentences and their Hansard and Google references.
+    """
+    test_set = {}
+    for name, file, language in (('french', 'Task5.f', 'f'), ('eng', 'Task5.e', 'e'),
+                                 ('eng_g', 'Task5.google.e', 'e')):
+        with open(os.path.join(test_dir, file), 'r') as data:
+            test_set[name] = [preprocess(line, language) for line in data]
+    return test_set
+
+
+def write_results(results, out_dir, ngram_sizes, discussion=''):
+    """
+    Write the grid results to out_dir as results.json, results.csv (one row per
+    point and n) and the Task5.txt report.
+    """
+    with open(os.path.join(out_dir, 'results.json'), 'w') as handle:
+        json.dump(results, handle, indent=2)
+
+    with open(os.path.join(out_dir, 'results.csv'), 'w', newline='') as handle:
+        writer = csv.writer(handle)
+        writer.writerow(['num_sentences', 'max_iter', 'n', 'mean_bleu', 'corpus_bleu', 'ci_low', 'ci_high',
+                         'error'])
+        for result in results:
+            if 'error' in result:
+                writer.writerow([result['num_sentences'], result['max_iter'], '', '', '', '', '',
+                                 result['error'].splitlines()[-1]])
+                continue
+            for n in ngram_sizes:
+                scores = result['bleu'][str(n)]
+                writer.writerow([result['num_sentences'], result['max_iter'], n, scores['mean'], scores['corpus'],
+                                 scores['low'], scores['high'], ''])
+
+    with open(os.path.join(out_dir, 'Task5.txt'), 'w') as f:
+        f.write(discussion)
+        f.write("\n\n")
+        f.write("-" * 10 + "Evaluation START" + "-" * 10 + "\n")
+
+        for result in results:
+            f.write("\n### Evaluating AM model: {} sentences, {} iterations ### \n".format(
+                result['num_sentences'], result['max_iter']))
+            if 'error' in result:
+                f.write("\nFailed: {}\n".format(result['error'].splitlines()[-1]))
+                continue
+            for n in ngram_sizes:
+                scores = result['bleu'][str(n)]
+                f.write("\nBLEU scores with N-gram (n) = {}: ".format(n))
+                for v in scores['sentences']:
+                    f.write("\t{:1.4f}".format(v))
+                f.write("\n\tcorpus BLEU {:1.4f}, 95% CI [{:1.4f}, {:1.4f}]".format(
+                    scores['corpus'], scores['low'], scores['high']))
+            f.write("\n\n")
+
+        f.write("-" * 10 + "Evaluation END" + "-" * 10 + "\n")
+
+
+# ------------ Support functions --------------
+def _point_key(num_sentences, config, test_set):
+    params = [GRID_VERSION, os.path.abspath(config['train_dir']), num_sentences, config['max_iter'],
+              config['ngram_sizes'], config['backend'], sorted(config['options'].items()), test_set, config['LM']]
+    if config['tol'] is not None:
+        params.append(config['tol'])
+    params = json.dumps(params, sort_keys=True)
+    return hashlib.sha1(params.encode('utf-8')).hexdigest()[:12]
+
+
+def _point_file(points_dir, num_sentences, config, test_set):
+    return os.path.join(points_dir, 'point-{}-{}.json'.format(num_sentences, _point_key(num_sentences, config,
+                                                                                        test_set)))
+
+
+def _save_point(points_dir, num_sentences, config, test_set, result, failed):
+    """
+    Write a finished point. Failed points are only collected in failed, so they run
+    again next time.
+    """
+    if 'error' in result:
+        print('sentences: {}, failed:\n{}'.format(num_sentences, result['error']))
+        failed[num_sentences] = result
+        return
+
+    point_file = _point_file(points_dir, num_sentences, config, test_set)
+    tmp = '{}.{}.tmp'.format(point_file, os.getpid())
+    with open(tmp, 'w') as handle:
+        json.dump(result, handle, indent=2)
+    os.replace(tmp, point_file)
+
+    for n in config['ngram_sizes']:
+        print('sentences: {}, bigram count: {}, average: {}'.format(num_sentences, n, result['bleu'][str(n)]['mean']))
+
+
+def _run_points(points, workers, LM, test_set, config, points_dir, failed):
+    """
+    Run grid points in a pool of worker processes and save them as they finish.
+    Returns the points lost because a worker process died.
+    """
+    broken = []
+    with ProcessPoolExecutor(workers, initializer=_init_grid_worker, initargs=(LM, test_set, config)) as executor:
+        futures = {executor.submit(_grid_task, num_sentences): num_sentences for num_sentences in points}
+        for future in as_completed(futures):
+            try:
+                num_sentences, result = future.result()
+            except BrokenProcessPool:
+                broken.append(futures[future])
+                continue
+            _save_point(points_dir, num_sentences, config, test_set, result, failed)
+    return sorted(broken, reverse=True)
+
+
+_grid_worker = {}
+
+
+def _init_grid_worker(LM, test_set, config):
+    _grid_worker.update(LM=LM, test_set=test_set, config=config)
+
+
+def _grid_task(num_sentences):
+    config = _grid_worker['config']
+    test_set = _grid_worker['test_set']
+    result = {'num_sentences': num_sentences, 'max_iter': config['max_iter']}
+
+    try:
+        AM = get_cached_AM(config['train_dir'], num_sentences, config['max_iter'], config['am_dir'],
+                           config['backend'], config['tol'], config['checkpoint_every'])
+        eng_decoded = decode.decode_many(test_set['french'], _grid_worker['LM'], AM,
+                                         workers=config['decode_workers'], **config['options'])
+    except Exception:
+        result['error'] = traceback.format_exc()
+        return num_sentences, result
+
+    references = list(zip(test_set['eng'], test_set['eng_g']))
+    result['decoded'] = eng_decoded
+    result['bleu'] = {}
+    for n in config['ngram_sizes']:
+        stats = sentence_statistics(eng_decoded, references, n)
+        scores = [sentence_bleu(candidate, r, n) for candidate, r in zip(eng_decoded, references)]
+        interval = bootstrap_bleu(stats, n)
+        result['bleu'][str(n)] = {'sentences': scores, 'mean': float(np.mean(scores)), 'corpus': interval['bleu'],
+                                  'low': interval['low'], 'high': interval['high'], 'stats': stats.tolist()}
+
+    return num_sentences, result
@@ -0,0 +1,167 @@
+from preprocess import *
+from preprocess_cache import *
+from array import array
+import numpy as np
+import json
+import os
+
+CORPUS_VERSION = 1
+META_FILE = 'meta.json'
+
+
+def compile_hansard(train_dir, out_dir, num_sentences=None):
+    """
+    Preprocess the aligned Hansard sentence pairs in train_dir once and write them
+    to out_dir as a compact token-id corpus that open_hansard can memory map.
+
+    INPUTS:
+    train_dir :     (string) The top-level directory name containing data
+                    e.g., '/u/cs401/A2_SMT/data/Hansard/Training/'
+    out_dir :       (string) the directory to write the compiled corpus to
+    num_sentences : (int) the maximum number of sentence pairs to compile, None for all
+
+    OUTPUT:
+    num_sentences : (int) the number of sentence pairs written
+
+    Files are read in the same order and with the same Task5 exclusion as read_hansard.
+    For each language l, out_dir holds
+        vocab.l     : one word per line, the word on line i has id i
+        l.ids       : int32 ids of all tokens of all sentences, back to back
+        l.offsets   : int64, sentence i is ids[offsets[i]:offsets[i + 1]]
+    plus meta.json with the format version and the number of sentences.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+
+    vocab = {'e': dict(), 'f': dict()}
+    ids = {'e': array('i'), 'f': array('i')}
+    offsets = {'e': array('q', [0]), 'f': array('q', [0])}
+    num_tokens = {'e': 0, 'f': 0}
+    handles = {language: {'ids': open(os.path.join(out_dir, language + '.ids'), 'wb'),
+                          'offsets': open(os.path.join(out_dir, language + '.offsets'), 'wb')}
+               for language in ('e', 'f')}
+
+    i = 0
+    for file in os.listdir(train_dir):
+        if num_sentences is not None and i == num_sentences:
+            break
+        if file[-1] != 'e' or 'Task5' in file:
+            continue
+
+        english_lines = preprocess_file(train_dir + file, 'e', splitlines=True)
+        french_lines = preprocess_file(train_dir + file[:-1] + 'f', 'f', splitlines=True)
+
+        for english_line, french_line in zip(english_lines, french_lines):
+            if num_sentences is not None and i == num_sentences:
+                break
+
+            for language, words in (('e', english_line), ('f', french_line)):
+                for word in words:
+                    if word not in vocab[language]:
+                        vocab[language][word] = len(vocab[language])
+                    ids[language].append(vocab[language][word])
+                num_tokens[language] += len(words)
+                offsets[language].append(num_tokens[language])
+            i += 1
+
+            for language in ('e', 'f'):
+                if len(ids[language]) >= 1 << 20:
+                    _flush(ids[language], handles[language]['ids'])
+                    _flush(offsets[language], handles[language]['offsets'])
+
+    for language in ('e', 'f'):
+        _flush(ids[language], handles[language]['ids'])
+        _flush(offsets[language], handles[language]['offsets'])
+        handles[language]['ids'].close()
+        handles[language]['offsets'].close()
+
+        with open(os.path.join(out_dir, 'vocab.' + language), 'w') as vocab_file:
+            for word in vocab[language]:
+                vocab_file.write(word + '\n')
+
+    with open(os.path.join(out_dir, META_FILE), 'w') as meta_file:
+        json.dump({'version': CORPUS_VERSION, 'num_sentences': i,
+                   'num_tokens': num_tokens, 'source': os.path.abspath(train_dir)}, meta_file)
+
+    return i
+
+
+def is_compiled_corpus(path):
+    """
+    True if path is a directory written by compile_hansard.
+    """
+    return os.path.isfile(os.path.join(path, META_FILE))
+
+
+def open_hansard(corpus_dir):
+    """
+    Open a compiled corpus. The id and offset arrays are memory mapped, so opening
+    is instant and only the pages that are touched get read.
+
+    OUTPUT:
+    corpus : (dictionary) corpus['e'] and corpus['f'] each hold 'ids', 'offsets' and
+             'vocab' (id -> word list); corpus['num_sentences'] is the number of pairs
+    """
+    with open(os.path.join(corpus_dir, META_FILE), 'r') as meta_file:
+        meta = json.load(meta_file)
+
+    if meta['version'] != CORPUS_VERSION:
+        raise ValueError('{} has corpus format version {}, expected {}'.format(
+            corpus_dir, meta['version'], CORPUS_VERSION))
+
+    corpus = {'num_sentences': meta['num_sentences']}
+    for language in ('e', 'f'):
+        with open(os.path.join(corpus_dir, 'vocab.' + language), 'r') as vocab_file:
+            vocab = vocab_file.read().splitlines()
+
+        corpus[language] = {
+            'ids': _memmap(os.path.join(corpus_dir, language + '.ids'), np.int32),
+            'offsets': _memmap(os.path.join(corpus_dir, language + '.offsets'), np.int64),
+            'vocab': vocab,
+        }
+
+    return corpus
+
+
+def iter_sentence_pairs(corpus, num_sentences=None, batch_size=1000):
+    """
+    Stream the first num_sentences pairs of an open corpus as batches of
+    (english, french) lists of token lists, as read_hansard would return them.
+    """
+    n = corpus['num_sentences'] if num_sentences is None else min(num_sentences, corpus['num_sentences'])
+
+    for lo in range(0, n, batch_size):
+        hi = min(lo + batch_size, n)
+        yield tuple(_decode(corpus[language], lo, hi) for language in ('e', 'f'))
+
+
+def _decode(side, lo, hi):
+    vocab = side['vocab']
+    offsets = side['offsets'][lo:hi + 1].tolist()
+    ids = side['ids'][offsets[0]:offsets[-1]].tolist()
+    base = offsets[0]
+
+    return [[vocab[token] for token in ids[offsets[k] - base:offsets[k + 1] - base]]
+            for k in range(hi - lo)]
+
+
+def _memmap(path, dtype):
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=dtype)
+
+    return np.memmap(path, dtype=dtype, mode='r')
+
+
+def _flush(buffer, handle):
+    buffer.tofile(handle)
+    del buffer[:]
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Compile a Hansard directory into a token-id corpus")
+    parser.add_argument('train_dir', help="directory containing the aligned .e/.f files")
+    parser.add_argument('out_dir', help="directory to write the compiled corpus to")
+    parser.add_argument('--num-sentences', type=int, default=None)
+    args = parser.parse_args()
+    print(compile_hansard(args.train_dir, args.out_dir, args.num_sentences))
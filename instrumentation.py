@@ -0,0 +1,151 @@
+import functools
+import atexit
+import time
+import sys
+import os
+
+# Set SMT_INSTRUMENT=1 (or true, yes, on) to time the instrumented stages and print a summary at exit.
+# Set SMT_PROFILE to a file name to also capture a cProfile profile there.
+_enabled = False
+_stages = dict()
+_counters = dict()
+_profile = {'profiler': None, 'path': None}
+_registered = []
+
+
+def instrumented(name, items=None):
+    """
+    Decorator timing every call of a pipeline stage while instrumentation is on.
+
+    INPUTS:
+    name :  (string) the stage name used in the summary
+    items : (function) items(args, result) gives the amount of work a call did (e.g.
+            the number of sentences), 1 per call by default
+
+    When instrumentation is off the wrapper only checks a flag and calls through.
+    """
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+
+            start = time.perf_counter()
+            result = function(*args, **kwargs)
+            elapsed = time.perf_counter() - start
+
+            stage = _stages.get(name)
+            if stage is None:
+                stage = _stages[name] = [0, 0.0, 0]
+            stage[0] += 1
+            stage[1] += elapsed
+            stage[2] += 1 if items is None else items(args, result)
+            return result
+
+        return wrapper
+
+    return decorate
+
+
+def increment(name, n=1):
+    """
+    Add n to the counter name, if instrumentation is on.
+    """
+    if _enabled:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+def enable_instrumentation(profile=None, report_at_exit=True):
+    """
+    Start timing the instrumented stages.
+
+    INPUTS:
+    profile :           (string) also run cProfile and dump its statistics to this file
+    report_at_exit :    (boolean) print report_instrumentation() when the program exits
+
+    Only the calling process is measured: stages run by worker processes (e.g.
+    decode_many with workers > 1) are not included.
+    """
+    global _enabled
+    _enabled = True
+
+    if profile and _profile['profiler'] is None:
+        import cProfile
+        _profile['profiler'] = cProfile.Profile()
+        _profile['path'] = profile
+        _profile['profiler'].enable()
+
+    if report_at_exit and not _registered:
+        atexit.register(_at_exit)
+        _registered.append(True)
+
+
+def instrumentation_enabled():
+    """
+    Whether the instrumented stages are being timed.
+    """
+    return _enabled
+
+
+def disable_instrumentation():
+    """
+    Stop timing, and stop the profiler if it runs, dumping its statistics.
+    """
+    global _enabled
+    _enabled = False
+
+    profiler = _profile['profiler']
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(_profile['path'])
+        _profile['profiler'] = None
+
+
+def reset_instrumentation():
+    """
+    Forget the measurements so far.
+    """
+    _stages.clear()
+    _counters.clear()
+
+
+def instrumentation_summary():
+    """
+    OUTPUT:
+    summary :   (dictionary) 'stages' maps every stage to its 'calls', 'seconds'
+                (total), 'mean' (seconds per call) and 'items'; 'counters' maps
+                every counter to its value
+    """
+    stages = {name: {'calls': calls, 'seconds': seconds, 'mean': seconds / calls, 'items': items}
+              for name, (calls, seconds, items) in _stages.items()}
+
+    return {'stages': stages, 'counters': dict(_counters)}
+
+
+def report_instrumentation(file=None):
+    """
+    Print the per-stage summary, slowest stage first.
+    """
+    if file is None:
+        file = sys.stderr
+    summary = instrumentation_summary()
+
+    print('{:<20} {:>10} {:>12} {:>12} {:>12}'.format('stage', 'calls', 'total (s)', 'mean (ms)', 'items'),
+          file=file)
+    for name, stage in sorted(summary['stages'].items(), key=lambda item: -item[1]['seconds']):
+        print('{:<20} {:>10} {:>12.4f} {:>12.4f} {:>12}'.format(
+            name, stage['calls'], stage['seconds'], 1000 * stage['mean'], stage['items']), file=file)
+    for name, value in sorted(summary['counters'].items()):
+        print('{:<20} {:>10}'.format(name, value), file=file)
+    if _profile['path'] is not None:
+        print('cProfile statistics: {}'.format(_profile['path']), file=file)
+
+
+def _at_exit():
+    if _enabled:
+        disable_instrumentation()
+        report_instrumentation()
+
+
+if os.environ.get('SMT_INSTRUMENT', '').strip().lower() in ('1', 'true', 'yes', 'on') or os.environ.get('SMT_PROFILE'):
+    enable_instrumentation(profile=os.environ.get('SMT_PROFILE'))
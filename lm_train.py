@@ -1,9 +1,13 @@
 from preprocess import *
+from preprocess_cache import *
+from instrumentation import *
+from multiprocessing import Pool
 import pickle
 import os
 
 
-def lm_train(data_dir, language, fn_LM):
+@instrumented('lm_train', items=lambda args, result: sum(result['uni'].values()))
+def lm_train(data_dir, language, fn_LM, workers=1):
     """
     This function reads data from data_dir, computes unigram and bigram counts,
     and writes the result to fn_LM
@@ -14,6 +18,9 @@ def lm_train(data_dir, language, fn_LM):
                     to train or decode. e.g., '/u/cs401/A2_SMT/data/Toy/'
     language	: (string) either 'e' (English) or 'f' (French)
     fn_LM		: (string) the location to save the language model once trained
+    workers		: (int) the number of processes to count the files with. Each file is
+                    counted separately and the counts are merged in file order, so
+                    the result (and the pickle) is the same for any number of workers.
 
     OUTPUT
 
@@ -30,32 +37,70 @@ def lm_train(data_dir, language, fn_LM):
     language_model['uni'] = dict()
     language_model['bi'] = dict()
 
-    for file in os.listdir(data_dir):
-        if file[-1] == language:
-            data = open(data_dir + file, 'r')
-            for line in data:
-                line = preprocess(line, language).split(' ')
-                for i in range(len(line)):
+    files = [data_dir + file for file in os.listdir(data_dir) if file[-1] == language]
 
-                    if line[i] not in language_model['uni']:
-                        language_model['uni'][line[i]] = 1
-                    else:
-                        language_model['uni'][line[i]] += 1
-
-                    if i != 0:
-                        if line[i - 1] not in language_model['bi']:
-                            language_model['bi'][line[i - 1]] = dict()
-                            language_model['bi'][line[i - 1]][line[i]] = 1
-                        else:
-                            if line[i] not in language_model['bi'][line[i - 1]]:
-                                language_model['bi'][line[i - 1]][line[i]] = 1
-                            else:
-                                language_model['bi'][line[i - 1]][line[i]] += 1
-
-            data.close()
+    if workers > 1:
+        with Pool(workers) as pool:
+            for counts in pool.imap(_count_file, [(file, language) for file in files]):
+                merge_counts(language_model, counts)
+    else:
+        for file in files:
+            count_ngrams(file, language, language_model)
 
     # Save Model
     with open(fn_LM + '.pickle', 'wb') as handle:
         pickle.dump(language_model, handle, protocol=pickle.HIGHEST_PROTOCOL)
 
     return language_model
+
+
+def count_ngrams(path, language, language_model):
+    """
+    Add the unigram and bigram counts of the file at path to language_model.
+    """
+    for line in preprocess_file(path, language):
+        for i in range(len(line)):
+
+            if line[i] not in language_model['uni']:
+                language_model['uni'][line[i]] = 1
+            else:
+                language_model['uni'][line[i]] += 1
+
+            if i != 0:
+                if line[i - 1] not in language_model['bi']:
+                    language_model['bi'][line[i - 1]] = dict()
+                    language_model['bi'][line[i - 1]][line[i]] = 1
+                else:
+                    if line[i] not in language_model['bi'][line[i - 1]]:
+                        language_model['bi'][line[i - 1]][line[i]] = 1
+                    else:
+                        language_model['bi'][line[i - 1]][line[i]] += 1
+
+    return language_model
+
+
+def merge_counts(language_model, counts):
+    """
+    Add the counts of another language model to language_model. New words are
+    appended in the order they appear in counts.
+    """
+    uni = language_model['uni']
+    for word, count in counts['uni'].items():
+        uni[word] = uni.get(word, 0) + count
+
+    bi = language_model['bi']
+    for previous_word, successors in counts['bi'].items():
+        if previous_word not in bi:
+            bi[previous_word] = dict(successors)
+        else:
+            merged = bi[previous_word]
+            for word, count in successors.items():
+                merged[word] = merged.get(word, 0) + count
+
+    return language_model
+
+
+def _count_file(args):
+    path, language = args
+
+    return count_ngrams(path, language, {'uni': dict(), 'bi': dict()})
@@ -1,7 +1,11 @@
 from preprocess import *
 from lm_train import *
+from compact_lm import *
+from instrumentation import *
 from math import log2
+import numpy as np
 
+@instrumented('log_prob')
 def log_prob(sentence, LM, smoothing=False, delta=0, vocabSize=0):
     """
     Compute the LOG probability of a sentence, given a language model and whether or not to
@@ -53,3 +57,101 @@ def log_prob(sentence, LM, smoothing=False, delta=0, vocabSize=0):
         log_prob += prob
 
     return log_prob
+
+
+def log_prob_batch(sentences, LM, smoothing=False, delta=0, vocabSize=0):
+    """
+    Compute log_prob for many sentences at once. The sentences are converted to id
+    arrays and all bigram and unigram counts are gathered in a few array operations.
+
+    INPUTS:
+    sentences : (list) PROCESSED sentences (strings)
+    LM :        (dictionary or CompactLM) the language model; a dictionary is
+                converted with compact_lm first
+    smoothing, delta, vocabSize : as for log_prob
+
+    OUTPUT:
+    log_probs : (numpy array) log_prob(sentence, LM, smoothing, delta, vocabSize)
+                for every sentence
+    """
+    CLM = LM if isinstance(LM, CompactLM) else compact_lm(LM)
+    ids, lengths = sentences_to_ids(sentences, CLM)
+
+    return log_prob_ids(ids, lengths, CLM, smoothing, delta, vocabSize)
+
+
+def sentences_to_ids(sentences, CLM):
+    """
+    Map processed sentences (strings or token lists) to one flat array of word ids
+    (len(CLM.words) for unknown words) and the number of tokens in each sentence.
+    """
+    word_ids = CLM.ids
+    unknown = len(CLM.words)
+    ids = []
+    lengths = []
+
+    for sentence in sentences:
+        words = sentence.split(' ') if isinstance(sentence, str) else sentence
+        ids.extend([word_ids.get(word, unknown) for word in words])
+        lengths.append(len(words))
+
+    return np.array(ids, dtype=np.int64), np.array(lengths, dtype=np.int64)
+
+
+def bigram_statistics(ids, lengths, CLM):
+    """
+    Gather, for every bigram of every sentence, the sentence it belongs to, whether
+    its first word is in LM['uni'], the count of that word, the bigram count, and
+    the bigram count smoothed log_prob ends up using (see _carry_bigram_counts).
+    """
+    starts = np.cumsum(lengths) - lengths
+    sentence = np.repeat(np.arange(len(lengths)), lengths)
+    position = np.arange(len(ids))
+    bigram = position[position != starts[sentence]]
+
+    previous_ids = ids[bigram - 1]
+    known = previous_ids < CLM.num_unigrams
+    uni_counts = np.where(known, CLM.uni_counts[np.minimum(previous_ids, max(len(CLM.words) - 1, 0))], 0)
+    bi_counts = CLM.bigram_counts(previous_ids, ids[bigram])
+
+    stats = {
+        'sentence': sentence[bigram],
+        'known': known,
+        'uni': uni_counts,
+        'bi': bi_counts,
+        'first': starts[sentence[bigram]] - sentence[bigram],
+    }
+    stats['carried'] = _carry_bigram_counts(stats)
+
+    return stats
+
+
+def log_prob_ids(ids, lengths, CLM, smoothing=False, delta=0, vocabSize=0, stats=None):
+    """
+    log_prob_batch for sentences already converted by sentences_to_ids.
+    stats may hold the result of bigram_statistics to avoid recomputing it.
+    """
+    if stats is None:
+        stats = bigram_statistics(ids, lengths, CLM)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if smoothing is False:
+            probabilities = np.where(stats['known'] & (stats['bi'] > 0),
+                                     np.log2(stats['bi'] / stats['uni']), float('-inf'))
+        else:
+            probabilities = np.log2((stats['carried'] + delta) / (stats['uni'] + (delta * vocabSize)))
+
+    return np.bincount(stats['sentence'], weights=probabilities, minlength=len(lengths))
+
+
+def _carry_bigram_counts(stats):
+    """
+    With smoothing, log_prob leaves bi_count untouched when the previous word is
+    not in LM['uni'], so such a bigram reuses the count of the bigram before it in
+    the sentence. Reproduce that so the scores agree. 'first' is the index of the
+    first bigram of each bigram's sentence.
+    """
+    index = np.arange(len(stats['known']))
+    source = np.maximum.accumulate(np.where(stats['known'], index, -1)) if len(index) else index
+
+    return np.where(source >= stats['first'], stats['bi'][np.maximum(source, 0)], 0)
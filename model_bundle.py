@@ -0,0 +1,367 @@
+from collections.abc import Mapping, Sequence
+from compact_lm import *
+import numpy as np
+import hashlib
+import json
+import time
+import os
+
+BUNDLE_VERSION = 1
+BUNDLE_SUFFIX = '.bundle'
+MAGIC = b'SMTBNDL\0'
+ALIGNMENT = 64
+
+
+def save_lm_bundle(LM, fn_LM, params=None, corpus=None):
+    """
+    Save a language model from lm_train to fn_LM + '.bundle'.
+
+    INPUTS:
+    LM :        (dictionary) the language model, or a CompactLM
+    fn_LM :     (string) the location to save the bundle
+    params :    (dictionary) the training parameters, recorded in the header
+    corpus :    (string) the corpus hash (see corpus_hash), recorded in the header
+
+    The counts are stored in the CSR layout of CompactLM, with the words sorted so
+    load_lm_bundle can look them up without building a dictionary.
+    """
+    CLM = LM if isinstance(LM, CompactLM) else compact_lm(LM)
+    n = len(CLM.words)
+
+    # unigram words first, as CompactLM expects, each range sorted
+    order = sorted(range(CLM.num_unigrams), key=CLM.words.__getitem__) + \
+            sorted(range(CLM.num_unigrams, n), key=CLM.words.__getitem__)
+    new_id = np.empty(n, dtype=np.int64)
+    new_id[order] = np.arange(n)
+
+    previous_ids = new_id[np.repeat(np.arange(n), np.diff(CLM.bi_offsets))]
+    successors = new_id[CLM.bi_successors]
+    bigrams = np.lexsort((successors, previous_ids))
+    bi_offsets = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(previous_ids, minlength=n), out=bi_offsets[1:])
+
+    arrays = _vocab_arrays('vocab', [CLM.words[i] for i in order])
+    arrays.update(uni_counts=np.asarray(CLM.uni_counts)[order],
+                  bi_offsets=bi_offsets,
+                  bi_successors=successors[bigrams].astype(np.int32),
+                  bi_counts=np.asarray(CLM.bi_counts)[bigrams])
+
+    info = {'num_unigrams': CLM.num_unigrams}
+    save_bundle(fn_LM + BUNDLE_SUFFIX, 'LM', arrays, params, corpus, info)
+
+
+def save_am_bundle(AM, fn_AM, params=None, corpus=None, N=5):
+    """
+    Save an alignment model from align_ibm1 to fn_AM + '.bundle'.
+
+    INPUTS:
+    AM :        (dictionary) the alignment model
+    fn_AM :     (string) the location to save the bundle
+    params :    (dictionary) the training parameters, recorded in the header
+    corpus :    (string) the corpus hash (see corpus_hash), recorded in the header
+    N :         (int) the number of candidates per French word kept in the stored
+                decode candidate index
+
+    The bundle also holds decode.build_candidate_index(AM, N), so decoding with the
+    loaded AM does not have to scan it.
+    """
+    from decode import build_candidate_index
+
+    e_words = sorted(AM)
+    f_words = sorted({f_word for translations in AM.values() for f_word in translations})
+    f_ids = {f_word: i for i, f_word in enumerate(f_words)}
+    e_ids = {e_word: i for i, e_word in enumerate(e_words)}
+
+    offsets = np.zeros(len(e_words) + 1, dtype=np.int64)
+    successors = []
+    probs = []
+    for i, e_word in enumerate(e_words):
+        row = sorted((f_ids[f_word], prob) for f_word, prob in AM[e_word].items())
+        successors.extend(f for f, prob in row)
+        probs.extend(prob for f, prob in row)
+        offsets[i + 1] = offsets[i] + len(row)
+
+    index = build_candidate_index(AM, N)
+    candidate_offsets = np.zeros(len(f_words) + 1, dtype=np.int64)
+    candidates = []
+    candidate_probs = []
+    for i, f_word in enumerate(f_words):
+        for e_word, prob in index.get(f_word, []):
+            candidates.append(e_ids[e_word])
+            candidate_probs.append(prob)
+        candidate_offsets[i + 1] = len(candidates)
+
+    arrays = _vocab_arrays('e_vocab', e_words)
+    arrays.update(_vocab_arrays('f_vocab', f_words))
+    arrays.update(offsets=offsets,
+                  f_ids=np.array(successors, dtype=np.int32),
+                  probs=np.array(probs, dtype=np.float64),
+                  candidate_offsets=candidate_offsets,
+                  candidates=np.array(candidates, dtype=np.int32),
+                  candidate_probs=np.array(candidate_probs, dtype=np.float64))
+
+    save_bundle(fn_AM + BUNDLE_SUFFIX, 'AM', arrays, params, corpus, {'N': N})
+
+
+def load_lm_bundle(fn_LM):
+    """
+    Memory map the language model saved at fn_LM + '.bundle'. Returns a CompactLM
+    whose arrays and vocabulary are read from the mapping on access.
+    """
+    header, arrays = load_bundle(fn_LM + BUNDLE_SUFFIX, 'LM')
+    words = MappedVocab(arrays['vocab_bytes'], arrays['vocab_offsets'],
+                        [0, header['num_unigrams'], len(arrays['vocab_offsets']) - 1])
+
+    CLM = CompactLM(words, arrays['uni_counts'], arrays['bi_offsets'], arrays['bi_successors'], arrays['bi_counts'],
+                    num_unigrams=header['num_unigrams'], ids=words.ids)
+    CLM.header = header
+    return CLM
+
+
+def load_am_bundle(fn_AM):
+    """
+    Memory map the alignment model saved at fn_AM + '.bundle'. Returns a MappedAM,
+    which answers AM['english_word']['foreign_word'] like the dictionary from align_ibm1.
+    """
+    header, arrays = load_bundle(fn_AM + BUNDLE_SUFFIX, 'AM')
+
+    return MappedAM(header, arrays)
+
+
+def save_bundle(path, kind, arrays, params=None, corpus=None, info=None):
+    """
+    Write arrays to a bundle file: MAGIC, the length of the JSON header as a
+    little-endian uint64, the header, then every array at a 64-byte aligned offset.
+    The header records the format version, the kind of model, the training
+    parameters, the corpus hash and the dtype, shape and offset of every array.
+    The file is written under a temporary name and renamed.
+    """
+    header = dict(info or {})
+    header.update(format_version=BUNDLE_VERSION, kind=kind, params=params or {}, corpus=corpus,
+                  created=time.strftime('%Y-%m-%dT%H:%M:%S'), arrays={})
+
+    offset = 0
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        arrays[name] = array
+        header['arrays'][name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset = _align(offset + array.nbytes)
+
+    encoded = json.dumps(header).encode('utf-8')
+    start = _align(len(MAGIC) + 8 + len(encoded))
+
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'wb') as handle:
+        handle.write(MAGIC)
+        handle.write(np.uint64(len(encoded)).astype('<u8').tobytes())
+        handle.write(encoded)
+        for name, array in arrays.items():
+            handle.write(b'\0' * (start + header['arrays'][name]['offset'] - handle.tell()))
+            handle.write(array.tobytes())
+    os.replace(tmp, path)
+
+
+def read_header(path):
+    """
+    The header of a bundle file, without mapping its arrays.
+    """
+    with open(path, 'rb') as handle:
+        if handle.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{} is not a model bundle'.format(path))
+        length = int(np.frombuffer(handle.read(8), dtype='<u8')[0])
+        header = json.loads(handle.read(length).decode('utf-8'))
+
+    if header['format_version'] != BUNDLE_VERSION:
+        raise ValueError('{} has bundle format version {}, expected {}'.format(
+            path, header['format_version'], BUNDLE_VERSION))
+    header['data_offset'] = _align(len(MAGIC) + 8 + length)
+    return header
+
+
+def load_bundle(path, kind=None):
+    """
+    Read the header of a bundle and memory map its arrays (read-only). Processes
+    loading the same bundle share its pages.
+    """
+    header = read_header(path)
+    if kind is not None and header['kind'] != kind:
+        raise ValueError('{} holds a {}, not a {}'.format(path, header['kind'], kind))
+
+    data = np.memmap(path, dtype=np.uint8, mode='r')
+    arrays = {}
+    for name, spec in header['arrays'].items():
+        dtype = np.dtype(spec['dtype'])
+        start = header['data_offset'] + spec['offset']
+        count = int(np.prod(spec['shape'], dtype=np.int64))
+        arrays[name] = data[start:start + count * dtype.itemsize].view(dtype).reshape(spec['shape'])
+
+    return header, arrays
+
+
+def corpus_hash(data_dir, languages='ef'):
+    """
+    sha1 of the names and contents of the files of data_dir ending with one of
+    languages, in sorted order.
+    """
+    sha1 = hashlib.sha1()
+    for file in sorted(os.listdir(data_dir)):
+        if file[-1] not in languages:
+            continue
+        sha1.update(file.encode('utf-8') + b'\0')
+        with open(os.path.join(data_dir, file), 'rb') as handle:
+            for chunk in iter(lambda: handle.read(1 << 20), b''):
+                sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+class MappedVocab(Sequence):
+    """
+    The words of a bundle, decoded from the mapped UTF-8 blob on access. The words
+    are sorted within each of the ranges given by bounds, so ids maps a word back to
+    its id by binary search, without decoding the whole vocabulary.
+    """
+
+    def __init__(self, blob, offsets, bounds):
+        self.blob = blob
+        self.offsets = offsets
+        self.bounds = bounds
+        self.ids = _VocabIds(self)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return self.blob[self.offsets[i]:self.offsets[i + 1]].tobytes().decode('utf-8')
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def find(self, word):
+        """
+        The id of word, None if it is not in the vocabulary.
+        """
+        key = word.encode('utf-8')
+        for start, end in zip(self.bounds[:-1], self.bounds[1:]):
+            lo, hi = start, end
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self.blob[self.offsets[mid]:self.offsets[mid + 1]].tobytes() < key:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            if lo < end and self.blob[self.offsets[lo]:self.offsets[lo + 1]].tobytes() == key:
+                return lo
+        return None
+
+
+class _VocabIds(Mapping):
+
+    def __init__(self, vocab):
+        self.vocab = vocab
+        self.cache = dict()
+
+    def __getitem__(self, word):
+        i = self.cache.get(word)
+        if i is None:
+            i = self.vocab.find(word)
+            if i is None:
+                raise KeyError(word)
+            self.cache[word] = i
+        return i
+
+    def __iter__(self):
+        return iter(self.vocab)
+
+    def __len__(self):
+        return len(self.vocab)
+
+
+class MappedAM(Mapping):
+    """
+    An alignment model stored in CSR form in a bundle: English word i translates to
+    the French words f_ids[offsets[i]:offsets[i + 1]] (sorted ids) with probabilities
+    probs[offsets[i]:offsets[i + 1]]. candidate_index maps every French word to its
+    decode candidates, as decode.build_candidate_index(AM, N) did when it was saved.
+    """
+
+    def __init__(self, header, arrays):
+        self.header = header
+        self.e_vocab = MappedVocab(arrays['e_vocab_bytes'], arrays['e_vocab_offsets'],
+                                   [0, len(arrays['e_vocab_offsets']) - 1])
+        self.f_vocab = MappedVocab(arrays['f_vocab_bytes'], arrays['f_vocab_offsets'],
+                                   [0, len(arrays['f_vocab_offsets']) - 1])
+        self.offsets = arrays['offsets']
+        self.f_ids = arrays['f_ids']
+        self.probs = arrays['probs']
+        self.candidate_N = header['N']
+        self.candidate_index = _Candidates(self, arrays['candidate_offsets'], arrays['candidates'],
+                                           arrays['candidate_probs'])
+
+    def __getitem__(self, e_word):
+        return _Translations(self, self.e_vocab.ids[e_word])
+
+    def __iter__(self):
+        return iter(self.e_vocab)
+
+    def __len__(self):
+        return len(self.e_vocab)
+
+
+class _Translations(Mapping):
+
+    def __init__(self, AM, e_id):
+        self.AM = AM
+        self.lo = int(AM.offsets[e_id])
+        self.hi = int(AM.offsets[e_id + 1])
+
+    def __getitem__(self, f_word):
+        f_id = self.AM.f_vocab.ids[f_word]
+        k = self.lo + int(np.searchsorted(self.AM.f_ids[self.lo:self.hi], f_id))
+        if k < self.hi and self.AM.f_ids[k] == f_id:
+            return float(self.AM.probs[k])
+        raise KeyError(f_word)
+
+    def __iter__(self):
+        return (self.AM.f_vocab[i] for i in self.AM.f_ids[self.lo:self.hi].tolist())
+
+    def __len__(self):
+        return self.hi - self.lo
+
+
+class _Candidates(Mapping):
+
+    def __init__(self, AM, offsets, candidates, probs):
+        self.AM = AM
+        self.offsets = offsets
+        self.candidates = candidates
+        self.probs = probs
+        self.cache = dict()
+
+    def __getitem__(self, f_word):
+        candidates = self.cache.get(f_word)
+        if candidates is None:
+            f_id = self.AM.f_vocab.ids[f_word]
+            lo, hi = int(self.offsets[f_id]), int(self.offsets[f_id + 1])
+            candidates = [(self.AM.e_vocab[e], prob)
+                          for e, prob in zip(self.candidates[lo:hi].tolist(), self.probs[lo:hi].tolist())]
+            self.cache[f_word] = candidates
+        return candidates
+
+    def __iter__(self):
+        return iter(self.AM.f_vocab)
+
+    def __len__(self):
+        return len(self.AM.f_vocab)
+
+
+# ------------ Support functions --------------
+def _vocab_arrays(name, words):
+    encoded = [word.encode('utf-8') for word in words]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(word) for word in encoded], out=offsets[1:])
+
+    return {name + '_bytes': np.frombuffer(b''.join(encoded), dtype=np.uint8),
+            name + '_offsets': offsets}
+
+
+def _align(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
@@ -1,5 +1,6 @@
 from log_prob import *
 from preprocess import *
+from preprocess_cache import *
 import os
 
 def preplexity(LM, test_dir, language, smoothing = False, delta = 0):
@@ -25,22 +26,93 @@ def preplexity(LM, test_dir, language, smoothing = False, delta = 0):
 		if ffile.split(".")[-1] != language:
 			continue
 
-		opened_file = open(test_dir+ffile, "r")
-		for line in opened_file:
-			processed_line = preprocess(line, language)
-			tpp = log_prob(processed_line, LM, smoothing, delta, vocab_size)
+		for tokens in preprocess_file(test_dir+ffile, language):
+			tpp = log_prob(' '.join(tokens), LM, smoothing, delta, vocab_size)
 
 			if tpp > float("-inf"):
 				pp = pp + tpp
-				N += len(processed_line.split())
-		opened_file.close()
+				N += len(tokens)
 	if N > 0:
 		pp = 2 ** (-pp / N)
 	return pp
 
-# i = [0.001, 0.01, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1]
+def preplexity_batch(LM, test_dir, language, smoothing = False, delta = 0):
+	"""
+	Same as preplexity, but scores the whole test corpus at once with log_prob_batch.
+	Sentences with a log probability of -inf are left out, as in preplexity.
+
+	OUTPUT:
+	pp :		(float) the preplexity
+	log_probs :	(numpy array) the log probability of every test sentence, in file order
+	"""
+	CLM = LM if isinstance(LM, CompactLM) else compact_lm(LM)
+	sentences = read_test_corpus(test_dir, language)
+	ids, lengths = sentences_to_ids(sentences, CLM)
+	log_probs = log_prob_ids(ids, lengths, CLM, smoothing, delta, len(LM["uni"]))
+
+	return _preplexity_from_scores(log_probs, lengths), log_probs
+
+
+def read_test_corpus(test_dir, language):
+	"""
+	The processed sentences (token lists) of every file in test_dir for the given
+	language, in the order preplexity visits them.
+	"""
+	sentences = []
+	for ffile in os.listdir(test_dir):
+		if ffile.split(".")[-1] == language:
+			sentences.extend(preprocess_file(test_dir+ffile, language))
+	return sentences
+
+
+def _preplexity_from_scores(log_probs, lengths):
+	# Accumulate in file order, as preplexity does, so the results are identical
+	finite = log_probs > float("-inf")
+	pp = 0
+	for tpp in log_probs[finite].tolist():
+		pp = pp + tpp
+	N = int(lengths[finite].sum())
+	if N > 0:
+		pp = 2 ** (-pp / N)
+	return pp
+
+
+def preplexity_sweep(LM, test_dir, language, deltas):
+	"""
+	Computes the preplexity without smoothing and with add-delta smoothing for
+	every delta in deltas, reading and counting the test corpus only once.
+
+	The bigram/history counts of the test corpus are gathered once; the distinct
+	(bigram count, history count) pairs are then scored for all deltas in a single
+	array operation and summed per sentence, so each extra delta costs one gather.
+	Every preplexity equals the one preplexity(LM, test_dir, language, ...) returns.
+
+	OUTPUT:
+	table :		(list) one dictionary per setting with the keys 'smoothing', 'delta'
+				and 'preplexity', starting with the unsmoothed model
+	"""
+	CLM = LM if isinstance(LM, CompactLM) else compact_lm(LM)
+	sentences = read_test_corpus(test_dir, language)
+	ids, lengths = sentences_to_ids(sentences, CLM)
+	stats = bigram_statistics(ids, lengths, CLM)
+	vocab_size = len(LM["uni"])
+
+	unsmoothed = log_prob_ids(ids, lengths, CLM, False, 0, vocab_size, stats)
+	table = [{'smoothing': False, 'delta': 0, 'preplexity': _preplexity_from_scores(unsmoothed, lengths)}]
+
+	pairs, inverse = np.unique(np.stack([stats['carried'], stats['uni']]), axis=1, return_inverse=True)
+	inverse = inverse.reshape(-1)
+	delta_column = np.array(deltas, dtype=np.float64)[:, None]
+	with np.errstate(divide='ignore', invalid='ignore'):
+		scores = np.log2((pairs[0] + delta_column) / (pairs[1] + (delta_column * vocab_size)))
+
+	for delta, pair_scores in zip(deltas, scores):
+		log_probs = np.bincount(stats['sentence'], weights=pair_scores[inverse], minlength=len(lengths))
+		table.append({'smoothing': True, 'delta': delta, 'preplexity': _preplexity_from_scores(log_probs, lengths)})
+
+	return table
+
 # LM_train = lm_train("data/Hansard/Training/", "e", "data/training_tmp")
 #
-# for j in i:
-# 	perplexity = preplexity(LM_train, "data/Hansard/Testing/", "e", False, j)
-# 	print('Delta = {}, Perplexity = {}'.format(j, perplexity))
+# for row in preplexity_sweep(LM_train, "data/Hansard/Testing/", "e", [0.001, 0.01, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1]):
+# 	print('Smoothing = {}, Delta = {}, Perplexity = {}'.format(row['smoothing'], row['delta'], row['preplexity']))
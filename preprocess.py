@@ -1,4 +1,9 @@
 import re
+from functools import lru_cache
+
+# Bump whenever a change to preprocess alters its output, so cached corpora
+# (see preprocess_cache) are rebuilt.
+PREPROCESS_VERSION = 2
 
 
 def preprocess(in_sentence, language):
@@ -15,24 +20,65 @@ def preprocess(in_sentence, language):
     OUTPUT:
     out_sentence: (string) the modified sentence
     """
-    out_sentence = in_sentence.lower()
-    out_sentence = re.sub('([\.\,\!\?\[\]\(\)\:\;\+\-\<\>\=\"])', r' \1 ', out_sentence)
-    out_sentence = re.sub('(\'\s)', r' \1 ', out_sentence)
-    out_sentence = re.sub(r'\s+', ' ', out_sentence).strip()
-    out_sentence = 'SENTSTART ' + out_sentence + ' SENTEND'
+    return ' '.join(preprocess_tokens(in_sentence, language))
+
+
+def preprocess_many(lines, language):
+    """
+    Preprocess an iterable of sentences, yielding the token list of each one.
+    Equivalent to preprocess(line, language).split(' ') for every line.
+    """
+    for line in lines:
+        yield preprocess_tokens(line, language)
+
+
+def preprocess_tokens(in_sentence, language):
+    """
+    Same as preprocess, but returns the list of tokens instead of joining them.
+
+    Punctuation and "' " are separated in a single scan, and whitespace is
+    normalized by splitting. The French elision rules only ever split a token
+    after an apostrophe, so they are applied, in order, to just the tokens that
+    contain one.
+    """
+    tokens = _PUNCTUATION.sub(r' \g<0> ', in_sentence.lower()).split()
 
     if language == 'f':
-        out_sentence = re.sub('(\s+l\')', r'\1 ', out_sentence)
-        out_sentence = re.sub('([bcfhjklmnpqrstvxz]\')(?=([a-z]))', r'\1 ', out_sentence)
-        out_sentence = re.sub('([d]\')(?!(abord|accord|ailleurs|habitude))(?=([a-z]))', r'\1 ', out_sentence)
-        out_sentence = re.sub('(\s+qu\')', r'\1 ', out_sentence)
-        out_sentence = re.sub('(\')(?=(on|il))', r'\1 ', out_sentence)
+        french_tokens = []
+        for token in tokens:
+            if "'" in token or '’' in token:
+                french_tokens.extend(_split_elisions(token))
+            else:
+                french_tokens.append(token)
+        tokens = french_tokens
+
+    return ['SENTSTART'] + tokens + ['SENTEND']
+
 
-        out_sentence = re.sub('(\s+l’)', r'\1 ', out_sentence)
-        out_sentence = re.sub('([bcfhjklmnpqrstvxz]’)(?=([a-z]))', r'\1 ', out_sentence)
-        out_sentence = re.sub('(\s+qu’)', r'\1 ', out_sentence)
-        out_sentence = re.sub('(’)(?=(on|il))', r'\1 ', out_sentence)
+# Punctuation to separate, and apostrophes followed by whitespace or punctuation.
+_PUNCTUATION = re.compile(r'[\.\,\!\?\[\]\(\)\:\;\+\-\<\>\=\"]|\'(?=[\s\.\,\!\?\[\]\(\)\:\;\+\-\<\>\=\"])')
 
-    out_sentence = re.sub(r'\s+', ' ', out_sentence).strip()
+_ELISIONS = [re.compile(pattern) for pattern in (
+    r'(\s+l\')',
+    r'([bcfhjklmnpqrstvxz]\')(?=([a-z]))',
+    r'([d]\')(?!(abord|accord|ailleurs|habitude))(?=([a-z]))',
+    r'(\s+qu\')',
+    r'(\')(?=(on|il))',
+    r'(\s+l’)',
+    r'([bcfhjklmnpqrstvxz]’)(?=([a-z]))',
+    r'(\s+qu’)',
+    r'(’)(?=(on|il))',
+)]
+
+
+@lru_cache(maxsize=65536)
+def _split_elisions(token):
+    """
+    Apply the French elision rules to a single token. The token is preceded by a
+    space, as it is inside the sentence, so the rules anchored on whitespace match.
+    """
+    out_token = ' ' + token
+    for pattern in _ELISIONS:
+        out_token = pattern.sub(r'\1 ', out_token)
 
-    return out_sentence
+    return tuple(out_token.split())
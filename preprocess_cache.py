@@ -0,0 +1,80 @@
+from preprocess import *
+from instrumentation import *
+import hashlib
+import pickle
+import os
+
+# Set SMT_CACHE_DIR to an empty string to disable the cache.
+CACHE_DIR = os.environ.get('SMT_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'smt', 'preprocess'))
+
+
+def preprocess_file(path, language, splitlines=False, cache_dir=None):
+    """
+    Return the preprocessed lines of a file, reading them from the cache when the
+    file has not changed since it was last preprocessed.
+
+    INPUTS:
+    path :       (string) the file to read
+    language :   (string) either 'e' (English) or 'f' (French)
+    splitlines : (boolean) split the file with str.splitlines, as read_hansard does,
+                 instead of iterating over it line by line, as lm_train does
+    cache_dir :  (string) where to keep the cache, defaults to CACHE_DIR
+
+    OUTPUT:
+    lines :      (list) the token list of every line of the file, as preprocess_tokens
+                 returns it
+
+    Entries are keyed by the absolute path, the file's size and modification time
+    and PREPROCESS_VERSION, so editing the file or the preprocessing rules
+    invalidates them. The entry for an older version of a file is replaced.
+    """
+    if cache_dir is None:
+        cache_dir = CACHE_DIR
+
+    if not cache_dir:
+        return _preprocess_lines(path, language, splitlines)
+
+    stat = os.stat(path)
+    source = '{}\0{}\0{}'.format(os.path.abspath(path), language, splitlines)
+    version = '{}\0{}\0{}'.format(stat.st_size, stat.st_mtime_ns, PREPROCESS_VERSION)
+    prefix = hashlib.sha1(source.encode('utf-8')).hexdigest()
+    entry = os.path.join(cache_dir, prefix + '-' + hashlib.sha1(version.encode('utf-8')).hexdigest() + '.pickle')
+
+    try:
+        with open(entry, 'rb') as handle:
+            lines = pickle.load(handle)
+        increment('preprocess_cache.hits')
+        return lines
+    except (OSError, EOFError, pickle.UnpicklingError):
+        pass
+    increment('preprocess_cache.misses')
+
+    lines = _preprocess_lines(path, language, splitlines)
+
+    # Other processes may be writing or evicting entries of the same file at the
+    # same time: the tmp name never matches an entry, only entries of other versions
+    # are evicted, and an entry that is already gone is not an error.
+    os.makedirs(cache_dir, exist_ok=True)
+    for stale in os.listdir(cache_dir):
+        if stale.startswith(prefix + '-') and stale.endswith('.pickle') and stale != os.path.basename(entry):
+            try:
+                os.remove(os.path.join(cache_dir, stale))
+            except FileNotFoundError:
+                pass
+
+    tmp = os.path.join(cache_dir, 'tmp-{}-{}'.format(os.getpid(), os.path.basename(entry)))
+    with open(tmp, 'wb') as handle:
+        pickle.dump(lines, handle, protocol=pickle.HIGHEST_PROTOCOL)
+    try:
+        os.replace(tmp, entry)
+    except FileNotFoundError:
+        pass
+
+    return lines
+
+
+def _preprocess_lines(path, language, splitlines):
+    with open(path, 'r') as data:
+        lines = data.read().splitlines() if splitlines else data
+
+        return list(preprocess_many(lines, language))
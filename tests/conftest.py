@@ -0,0 +1,31 @@
+import os
+import sys
+
+# the modules live at the repository root; keep the preprocessing cache out of ~
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ['SMT_CACHE_DIR'] = ''
+
+import pytest
+from benchmark import generate_hansard
+from lm_train import lm_train
+from align_ibm1 import align_ibm1
+
+NUM_SENTENCES = 300
+
+
+@pytest.fixture(scope='session')
+def hansard(tmp_path_factory):
+    """
+    A small synthetic Hansard: (training directory, testing directory).
+    """
+    return generate_hansard(str(tmp_path_factory.mktemp('hansard')), NUM_SENTENCES, vocab_size=400, seed=1, num_test=10)
+
+
+@pytest.fixture(scope='session')
+def LM(hansard, tmp_path_factory):
+    return lm_train(hansard[0], 'e', str(tmp_path_factory.mktemp('LM') / 'LM'))
+
+
+@pytest.fixture(scope='session')
+def AM(hansard, tmp_path_factory):
+    return align_ibm1(hansard[0], NUM_SENTENCES, 3, str(tmp_path_factory.mktemp('AM') / 'AM'))
@@ -0,0 +1,74 @@
+import math
+import random
+import numpy as np
+import pytest
+from BLEU_score import *
+from bleu_bootstrap import *
+
+
+def reference_BLEU_score(candidate, references, n, brevity=False):
+    # BLEU_score as it was before the n-gram counting was rewritten around bleu_stats
+    candidate_n = to_ngram(candidate, n)
+    references_n = [to_ngram(reference, n) for reference in references]
+    C = sum(1 for ngram in candidate_n if any(ngram in reference_n for reference_n in references_n))
+    bleu_score = C / len(candidate_n)
+
+    if brevity > 0:
+        diff = None
+        candidate_length = len(candidate.split(' '))
+        for reference in references:
+            ref_length = len(reference.split(' '))
+            if diff is None or math.fabs(candidate_length - ref_length) < diff:
+                diff = math.fabs(candidate_length - ref_length)
+                reference_length = ref_length
+        brevity_score = reference_length / candidate_length
+        bleu_score *= math.exp(1 - brevity_score) if brevity_score >= 1 else 1
+    return bleu_score
+
+
+def random_sentence(rng, words, length):
+    return ' '.join(['SENTSTART'] + [rng.choice(words) for _ in range(length)] + ['SENTEND'])
+
+
+def random_cases(count=300, seed=0):
+    rng = random.Random(seed)
+    words = ['a', 'b', 'c', 'd', 'e', 'f']
+    for _ in range(count):
+        candidate = random_sentence(rng, words, rng.randint(1, 12))
+        references = [random_sentence(rng, words, rng.randint(1, 12)) for _ in range(rng.randint(1, 3))]
+        yield candidate, references
+
+
+@pytest.mark.parametrize('n', [1, 2, 3])
+def test_BLEU_score_matches_reference(n):
+    for candidate, references in random_cases():
+        for brevity in (False, True):
+            assert BLEU_score(candidate, references, n, brevity) == reference_BLEU_score(candidate, references, n, brevity)
+
+
+@pytest.mark.parametrize('n', [1, 2, 3])
+def test_sentence_bleu_matches_reference(n):
+    # the geometric mean of the reference precisions, times the brevity penalty
+    for candidate, references in random_cases():
+        expected = 1
+        for k in range(1, n + 1):
+            expected *= reference_BLEU_score(candidate, references, k)
+        expected **= 1 / n
+        if expected:
+            expected *= reference_BLEU_score(candidate, references, 1, True) / reference_BLEU_score(candidate, references, 1)
+        assert sentence_bleu(candidate, references, n) == pytest.approx(expected, rel=1e-12, abs=0)
+
+
+@pytest.mark.parametrize('n', [1, 2, 3])
+def test_bootstrap_rows_match_corpus_bleu(n):
+    cases = list(random_cases(50, seed=n))
+    candidates = [candidate for candidate, references in cases]
+    references = [references for candidate, references in cases]
+    stats = sentence_statistics(candidates, references, n)
+
+    assert corpus_bleu_rows(stats.sum(axis=0), n)[0] == pytest.approx(corpus_bleu(candidates, references, n), rel=1e-12)
+
+    indices = bootstrap_indices(len(cases), samples=5, seed=0)
+    for row, score in zip(indices, corpus_bleu_rows(resample_sums(stats, indices), n)):
+        assert score == pytest.approx(corpus_bleu([candidates[i] for i in row], [references[i] for i in row], n),
+                                      rel=1e-12)
@@ -0,0 +1,20 @@
+import pytest
+from align_ibm1 import *
+
+
+def assert_same_AM(AM, expected):
+    assert AM.keys() == expected.keys()
+    for e_word, translations in expected.items():
+        assert AM[e_word].keys() == translations.keys()
+        for f_word, prob in translations.items():
+            assert AM[e_word][f_word] == pytest.approx(prob, rel=1e-9, abs=1e-12)
+
+
+def test_numpy_backend_matches_python(hansard, AM, tmp_path):
+    AM_numpy = align_ibm1(hansard[0], 300, 3, str(tmp_path / 'AM'), backend='numpy')
+    assert_same_AM(AM_numpy, AM)
+
+
+def test_sharded_em_matches_python(hansard, AM, tmp_path):
+    AM_sharded = align_ibm1(hansard[0], 300, 3, str(tmp_path / 'AM'), backend='numpy', workers=2)
+    assert_same_AM(AM_sharded, AM)
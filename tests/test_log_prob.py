@@ -0,0 +1,23 @@
+import numpy as np
+import pytest
+from log_prob import *
+from preprocess import *
+from compact_lm import *
+
+
+@pytest.mark.parametrize('smoothing, delta', [(False, 0), (True, 0.1), (True, 1)])
+def test_log_prob_batch_matches_log_prob(hansard, LM, smoothing, delta):
+    test_dir = hansard[1]
+    sentences = []
+    for fn in ('hansard.test.e', 'Task5.e', 'Task5.google.e'):
+        with open(test_dir + fn) as f:
+            sentences.extend(preprocess(line, 'e') for line in f)
+    vocabSize = len(LM['uni'])
+
+    expected = np.array([log_prob(sentence, LM, smoothing, delta, vocabSize) for sentence in sentences])
+    if not smoothing:
+        # unseen bigrams must come out as -inf in both
+        assert np.isinf(expected).any()
+
+    np.testing.assert_array_equal(log_prob_batch(sentences, LM, smoothing, delta, vocabSize), expected)
+    np.testing.assert_array_equal(log_prob_batch(sentences, compact_lm(LM), smoothing, delta, vocabSize), expected)
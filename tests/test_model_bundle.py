@@ -0,0 +1,41 @@
+import numpy as np
+from model_bundle import *
+from log_prob import *
+from preprocess import *
+from decode import *
+
+
+def test_lm_bundle_round_trip(hansard, LM, tmp_path):
+    save_lm_bundle(LM, str(tmp_path / 'LM'))
+    CLM = load_lm_bundle(str(tmp_path / 'LM'))
+
+    assert dict(CLM['uni']) == LM['uni']
+    assert {previous_word: dict(successors) for previous_word, successors in CLM['bi'].items()} == \
+        {previous_word: successors for previous_word, successors in LM['bi'].items() if successors}
+
+    with open(hansard[1] + 'hansard.test.e') as f:
+        sentences = [preprocess(line, 'e') for line in f]
+    for smoothing, delta in ((False, 0), (True, 0.5)):
+        expected = [log_prob(sentence, LM, smoothing, delta, len(LM['uni'])) for sentence in sentences]
+        assert [log_prob(sentence, CLM, smoothing, delta, len(LM['uni'])) for sentence in sentences] == expected
+        np.testing.assert_array_equal(log_prob_batch(sentences, CLM, smoothing, delta, len(LM['uni'])), expected)
+
+
+def test_am_bundle_round_trip(hansard, LM, AM, tmp_path):
+    save_am_bundle(AM, str(tmp_path / 'AM'))
+    MAM = load_am_bundle(str(tmp_path / 'AM'))
+
+    assert {e_word: dict(translations) for e_word, translations in MAM.items()} == AM
+    assert get_candidate_index(MAM) == build_candidate_index(AM)
+
+
+def test_decode_with_bundles_matches_dictionaries(hansard, LM, AM, tmp_path):
+    save_lm_bundle(LM, str(tmp_path / 'LM'))
+    save_am_bundle(AM, str(tmp_path / 'AM'))
+    CLM = load_lm_bundle(str(tmp_path / 'LM'))
+    MAM = load_am_bundle(str(tmp_path / 'AM'))
+
+    with open(hansard[1] + 'Task5.f') as f:
+        sentences = [preprocess(line, 'f') for line in f]
+    for mode in ('random', 'beam'):
+        assert decode_many(sentences, CLM, MAM, seed=3, mode=mode) == decode_many(sentences, LM, AM, seed=3, mode=mode)
@@ -0,0 +1,62 @@
+import re
+from preprocess import *
+
+
+def reference_preprocess(in_sentence, language):
+    # preprocess as it was before it was rewritten around preprocess_tokens
+    out_sentence = in_sentence.lower()
+    out_sentence = re.sub(r'([\.\,\!\?\[\]\(\)\:\;\+\-\<\>\=\"])', r' \1 ', out_sentence)
+    out_sentence = re.sub(r"('\s)", r' \1 ', out_sentence)
+    out_sentence = re.sub(r'\s+', ' ', out_sentence).strip()
+    out_sentence = 'SENTSTART ' + out_sentence + ' SENTEND'
+
+    if language == 'f':
+        out_sentence = re.sub(r"(\s+l')", r'\1 ', out_sentence)
+        out_sentence = re.sub(r"([bcfhjklmnpqrstvxz]')(?=([a-z]))", r'\1 ', out_sentence)
+        out_sentence = re.sub(r"([d]')(?!(abord|accord|ailleurs|habitude))(?=([a-z]))", r'\1 ', out_sentence)
+        out_sentence = re.sub(r"(\s+qu')", r'\1 ', out_sentence)
+        out_sentence = re.sub(r"(')(?=(on|il))", r'\1 ', out_sentence)
+
+        out_sentence = re.sub(r'(\s+l’)', r'\1 ', out_sentence)
+        out_sentence = re.sub(r'([bcfhjklmnpqrstvxz]’)(?=([a-z]))', r'\1 ', out_sentence)
+        out_sentence = re.sub(r'(\s+qu’)', r'\1 ', out_sentence)
+        out_sentence = re.sub(r'(’)(?=(on|il))', r'\1 ', out_sentence)
+
+    out_sentence = re.sub(r'\s+', ' ', out_sentence).strip()
+
+    return out_sentence
+
+
+SENTENCES = {
+    'e': [
+        "The Minister's answer (page 12) was: no!",
+        "  I don't think -- so; do you?  ",
+        'He said "yes" + "no" = <maybe>. [Applause]',
+        "The members' benches are empty ' said he",
+        "",
+    ],
+    'f': [
+        "L'homme qu'il a vu d'abord, c'est l'été!",
+        "Je n'ai jamais dit qu'on l'aurait d'ailleurs; j'habite à Ottawa d'habitude.",
+        "D'accord : s'il le faut, m'a-t-il dit (lorsqu'il est là).",
+        "L’homme qu’on voit, c’est jusqu’à l’aube d’habitude.",
+        "Aujourd'hui, les députés d'en face l' ont dit ' ou pas",
+        "qu'il, qu'elle, qu'on; puisqu'il d'Ottawa l'Ontario",
+    ],
+}
+
+
+def test_preprocess_matches_reference(hansard):
+    for language in 'ef':
+        sentences = list(SENTENCES[language])
+        for fn in (hansard[0] + 'hansard.0000.', hansard[1] + 'hansard.test.'):
+            with open(fn + language) as f:
+                sentences.extend(f)
+
+        for sentence in sentences:
+            expected = reference_preprocess(sentence, language)
+            assert preprocess(sentence, language) == expected
+            assert preprocess_tokens(sentence, language) == expected.split(' ')
+
+        assert list(preprocess_many(sentences, language)) == [reference_preprocess(s, language).split(' ')
+                                                             for s in sentences]
@@ -0,0 +1,366 @@
+from preprocess import *
+from model_bundle import *
+import decode
+from multiprocessing import Pool
+from collections import deque
+import socketserver
+import threading
+import socket
+import pickle
+import queue
+import json
+import time
+import os
+
+
+class TranslationServer:
+    """
+    A resident translator: the LM and AM are loaded once, and French sentences sent
+    over a Unix-domain socket (address is a path) or localhost TCP (address is a
+    (host, port) pair) are preprocessed and decoded by a pool of worker processes.
+
+    Protocol: one JSON object per line in each direction.
+        {"id": 1, "french": "Je suis ici."}  ->  {"id": 1, "english": "...", "latency": 0.01}
+        {"id": 2, "cmd": "stats"}            ->  {"id": 2, "stats": {...}}
+    Errors are answered with {"id": ..., "error": "..."}. A client may send many
+    requests without waiting; responses carry the request id and come back as soon
+    as their sentence is decoded.
+
+    Requests from all connections go through one queue. A batcher thread takes the
+    first waiting request, collects more for up to batch_wait seconds (or until it
+    has max_batch) and hands the batch to the pool, keeping at most `workers`
+    batches in flight. Sentence s is decoded with the seed decode.sentence_seed(seed, s),
+    so a translation does not depend on batching, on other clients or on workers. A
+    sentence that fails to decode only gets an error itself, not its whole batch.
+
+    Use as a context manager, or call close(), so the pool and the socket are released:
+
+        with TranslationServer(LM, AM, '/tmp/smt.sock', workers=4) as server:
+            server.serve_forever()
+    """
+
+    def __init__(self, LM, AM, address, workers=1, max_batch=32, batch_wait=0.005, seed=0, **options):
+        self.max_batch = max_batch
+        self.batch_wait = batch_wait
+        self.seed = seed
+        index = decode.get_candidate_index(AM)
+
+        # the pool forks before any server thread runs
+        if workers > 1:
+            self.pool = Pool(workers, initializer=decode.init_decode_worker, initargs=(LM, AM, index, seed, options))
+        else:
+            self.pool = None
+            decode.init_decode_worker(LM, AM, index, seed, options)
+
+        self.queue = queue.Queue()
+        self.in_flight = threading.BoundedSemaphore(max(workers, 1))
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {'requests': 0, 'translated': 0, 'errors': 0, 'batches': 0}
+        self.latencies = deque(maxlen=10000)
+
+        if isinstance(address, str):
+            if os.path.exists(address):
+                os.remove(address)
+            self.server = _UnixServer(address, _Handler)
+        else:
+            self.server = _TCPServer(address, _Handler)
+        self.address = self.server.server_address
+        self.server.translation_server = self
+
+        self.batcher = threading.Thread(target=self._batch_loop, daemon=True)
+        self.batcher.start()
+        self.thread = None
+
+    def serve_forever(self):
+        """
+        Answer requests until shutdown() is called from another thread.
+        """
+        self.server.serve_forever()
+
+    def start(self):
+        """
+        Answer requests from a background thread.
+        """
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def shutdown(self):
+        self.server.shutdown()
+
+    def close(self):
+        if self.thread is not None:
+            self.server.shutdown()
+            self.thread.join()
+        self.server.server_close()
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.remove(self.address)
+
+        self.queue.put(None)
+        self.batcher.join()
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def submit(self, french, callback):
+        """
+        Queue a raw French sentence. callback receives {'english', 'latency'} or {'error'}.
+        """
+        with self.lock:
+            self.counters['requests'] += 1
+        self.queue.put((time.perf_counter(), french, callback))
+
+    def statistics(self):
+        """
+        OUTPUT:
+        stats : (dictionary) the request, translation, error and batch counts, the mean
+                batch size, the translations per second since the start, and the mean,
+                median, 95th percentile and maximum latency (seconds) of the last
+                10000 translations
+        """
+        with self.lock:
+            stats = dict(self.counters)
+            latencies = sorted(self.latencies)
+
+        uptime = time.time() - self.started
+        stats.update(uptime=uptime, queued=self.queue.qsize(),
+                     mean_batch=(stats['translated'] + stats['errors']) / stats['batches'] if stats['batches'] else 0,
+                     throughput=stats['translated'] / uptime if uptime > 0 else 0)
+        if latencies:
+            stats.update(latency_mean=sum(latencies) / len(latencies),
+                         latency_p50=latencies[len(latencies) // 2],
+                         latency_p95=latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))],
+                         latency_max=latencies[-1])
+        return stats
+
+    def _batch_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+
+            batch = [item]
+            end = time.perf_counter() + self.batch_wait
+            while len(batch) < self.max_batch:
+                remaining = end - time.perf_counter()
+                try:
+                    item = self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self.queue.put(None)
+                    break
+                batch.append(item)
+
+            self.in_flight.acquire()
+            tasks = [(french, decode.sentence_seed(self.seed, french)) for start, french, callback in batch]
+            if self.pool is None:
+                self._deliver(batch, [_translate_task(task) for task in tasks])
+            else:
+                self.pool.map_async(_translate_task, tasks,
+                                    callback=lambda results, batch=batch: self._deliver(batch, results),
+                                    error_callback=lambda error, batch=batch: self._fail(batch, error))
+
+    def _deliver(self, batch, results):
+        try:
+            end = time.perf_counter()
+            translated = [(start, result) for (start, french, callback), result in zip(batch, results)
+                          if 'error' not in result]
+            with self.lock:
+                self.counters['batches'] += 1
+                self.counters['translated'] += len(translated)
+                self.counters['errors'] += len(batch) - len(translated)
+                self.latencies.extend(end - start for start, result in translated)
+            for (start, french, callback), result in zip(batch, results):
+                if 'error' not in result:
+                    result['latency'] = end - start
+                callback(result)
+        finally:
+            self.in_flight.release()
+
+    def _fail(self, batch, error):
+        # the pool itself failed (e.g. a worker died), not a sentence
+        try:
+            with self.lock:
+                self.counters['errors'] += len(batch)
+            for start, french, callback in batch:
+                callback({'error': '{}: {}'.format(type(error).__name__, error)})
+        finally:
+            self.in_flight.release()
+
+
+def translate(sentences, address, timeout=None):
+    """
+    Translate raw French sentences with a running TranslationServer.
+
+    INPUTS:
+    sentences : (list) the French sentences
+    address :   (string or tuple) the server's Unix socket path or (host, port)
+    timeout :   (float) socket timeout in seconds
+
+    OUTPUT:
+    english :   (list) the translations, in order
+    """
+    family = socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+    with socket.socket(family, socket.SOCK_STREAM) as connection:
+        connection.settimeout(timeout)
+        connection.connect(address)
+        with connection.makefile('rwb') as stream:
+            for i, french in enumerate(sentences):
+                stream.write((json.dumps({'id': i, 'french': french}) + '\n').encode('utf-8'))
+            stream.flush()
+
+            english = [None] * len(sentences)
+            for _ in sentences:
+                response = json.loads(stream.readline())
+                if 'error' in response:
+                    raise RuntimeError(response['error'])
+                english[response['id']] = response['english']
+
+    return english
+
+
+def load_models(fn_LM, fn_AM):
+    """
+    Load the LM and AM saved at fn_LM and fn_AM, memory mapping their bundles when
+    they exist (see model_bundle) and unpickling them otherwise.
+    """
+    models = []
+    for fn, load in ((fn_LM, load_lm_bundle), (fn_AM, load_am_bundle)):
+        if os.path.exists(fn + BUNDLE_SUFFIX):
+            models.append(load(fn))
+        else:
+            with open(fn + '.pickle', 'rb') as handle:
+                models.append(pickle.load(handle))
+    return models
+
+
+# ------------ Support functions --------------
+def _translate_task(task):
+    french, seed = task
+    try:
+        return {'english': decode.decode_in_worker(preprocess(french, 'f'), seed)}
+    except Exception as error:
+        return {'error': '{}: {}'.format(type(error).__name__, error)}
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    """
+    One connection. A reader thread parses the requests and submits them; the
+    responses, including those of the batcher and the pool, are queued and written
+    by the handler thread only, so a client that does not read its responses only
+    holds up its own connection, never the batcher or the other clients.
+    """
+
+    def handle(self):
+        responses = queue.Queue()
+        reader = threading.Thread(target=self._read_requests, args=(responses,), daemon=True)
+        reader.start()
+
+        reading = True
+        outstanding = 0     # translations submitted and not answered yet
+        connected = True
+        while reading or outstanding:
+            kind, response = responses.get()
+            if kind == 'submitted':
+                outstanding += 1
+                continue
+            if kind == 'end':
+                reading = False
+                continue
+            if kind == 'translation':
+                outstanding -= 1
+            if connected:
+                try:
+                    self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+                    self.wfile.flush()
+                except OSError:
+                    # the client went away, drop its responses
+                    connected = False
+
+    def _read_requests(self, responses):
+        server = self.server.translation_server
+
+        def done(response, request_id):
+            response['id'] = request_id
+            responses.put(('translation', response))
+
+        try:
+            for line in self.rfile:
+                if not line.strip():
+                    continue
+                try:
+                    request = json.loads(line)
+                except ValueError as error:
+                    responses.put(('response', {'id': None, 'error': 'invalid JSON: {}'.format(error)}))
+                    continue
+                if not isinstance(request, dict):
+                    responses.put(('response', {'id': None, 'error': 'requests must be JSON objects'}))
+                    continue
+
+                request_id = request.get('id')
+                if request.get('cmd') == 'stats':
+                    responses.put(('response', {'id': request_id, 'stats': server.statistics()}))
+                elif isinstance(request.get('french'), str):
+                    # queued before the translation can be, so it is counted first
+                    responses.put(('submitted', None))
+                    server.submit(request['french'], lambda response, request_id=request_id: done(response, request_id))
+                else:
+                    responses.put(('response', {'id': request_id,
+                                                'error': "expected a 'french' string or 'cmd': 'stats'"}))
+        except OSError:
+            pass
+        finally:
+            responses.put(('end', None))
+
+
+class _UnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+class _TCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+if __name__ == "__main__":
+    import argparse
+    import signal
+
+    parser = argparse.ArgumentParser(description="Serve translations of French sentences over a local socket")
+    parser.add_argument('--lm', default='LM', help="the English LM, as saved by lm_train or model_bundle")
+    parser.add_argument('--am', default='AM', help="the AM, as saved by align_ibm1 or model_bundle")
+    parser.add_argument('--socket', default=None, help="Unix socket path to listen on")
+    parser.add_argument('--port', type=int, default=8401, help="localhost TCP port, used without --socket")
+    parser.add_argument('--workers', type=int, default=1, help="decoding processes")
+    parser.add_argument('--max-batch', type=int, default=32, help="sentences per batch")
+    parser.add_argument('--batch-wait', type=float, default=5, help="milliseconds to wait to fill a batch")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--decoder', choices=['random', 'beam', 'local'], default='random')
+    parser.add_argument('--beam-width', type=int, default=8)
+    parser.add_argument('--window', type=int, default=3)
+    parser.add_argument('--deadline', type=float, default=None, help="seconds allowed per sentence")
+    args = parser.parse_args()
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+
+    LM, AM = load_models(args.lm, args.am)
+    address = args.socket if args.socket else ('127.0.0.1', args.port)
+    with TranslationServer(LM, AM, address, workers=args.workers, max_batch=args.max_batch,
+                           batch_wait=args.batch_wait / 1000, seed=args.seed, mode=args.decoder,
+                           beam_width=args.beam_width, window=args.window, deadline=args.deadline) as server:
+        # after the pool forked, so its workers keep the default handler
+        signal.signal(signal.SIGTERM, stop)
+        print('listening on {}'.format(server.address), flush=True)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass